@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Replace a file so that after a crash it has either the old or the new
+contents, never a partial file.
+
+The data is written to a temporary file next to it which is synced to
+disk and then renamed over the file.  The directory is synced too so
+the rename itself survives a power loss.
+Copyright (c) 2018 Robert Paauwe
+"""
+import os
+
+
+def write_file(path, data):
+    """ Replace path with data (bytes) """
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
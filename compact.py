@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Compaction of the recorded history into 1 minute, 1 hour and 1 day
+aggregates.
+
+Once a day is complete its segment is rolled up into one file per tier
+holding a (time, series, min, max, mean, count, last) record for each
+series and each minute/hour/day.  Each tier keeps its own number of
+days, so the raw values only need to be kept for a few days.
+
+Compaction runs in a low priority thread, one day at a time, pausing
+regularly so it doesn't compete with the ingest threads.  Tier files
+are written to a temporary file and renamed into place once synced, a
+day only counts as compacted when all of its tier files exist and the
+raw segment isn't deleted before that, so a crash during compaction
+just means the day is compacted again.
+Copyright (c) 2018 Robert Paauwe
+"""
+import os
+import struct
+import threading
+import time
+import atomic
+import history
+
+# time, series id, min, max, mean, count, last
+AGGREGATE = struct.Struct('<dIdddId')
+
+# name, seconds
+TIERS = (
+        ('minute', 60),
+        ('hour', 60 * 60),
+        ('day', 24 * 60 * 60),
+        )
+
+
+def aggregate(records, widths):
+    """
+    Roll (time stamp, series id, value) records, in time order, up into
+    aggregate records for each of the widths (seconds) in a single pass.
+    Returns a sorted list of aggregate records per width.
+    """
+    tiers = [{} for w in widths]
+    for ts, sid, value in records:
+        for width, slots in zip(widths, tiers):
+            key = (ts - (ts % width), sid)
+            a = slots.get(key)
+            if a is None:
+                slots[key] = [value, value, value, 1, value]
+                continue
+            if value < a[0]:
+                a[0] = value
+            if value > a[1]:
+                a[1] = value
+            a[2] += value
+            a[3] += 1
+            a[4] = value
+
+    result = []
+    for slots in tiers:
+        rows = []
+        for key in sorted(slots):
+            low, high, total, count, last = slots[key]
+            rows.append((key[0], key[1], low, high, total / count, count, last))
+        result.append(rows)
+    return result
+
+
+class Compactor(threading.Thread):
+
+    def __init__(self, store, logger, interval=600, batch=5000, pause=0.05):
+        threading.Thread.__init__(self, name='weather-compact')
+        self.daemon = True
+        self.store = store
+        self.logger = logger
+        self.interval = interval
+        self.batch = batch
+        self.pause = pause
+        self.retention = {}
+        self.compacted = 0
+        self.stopped = threading.Event()
+
+    def configure(self, retention):
+        """ retention is tier name -> days to keep, 0 to not keep the tier """
+        self.retention = retention
+
+    def enabled(self):
+        return any(self.retention.values())
+
+    def tier_path(self, tier, day):
+        return os.path.join(self.store.path, tier, history.segment_name(day))
+
+    def done(self, day):
+        """ True when the day doesn't need compacting (any more) """
+        today = int(time.time() // history.DAY)
+        for tier, width in TIERS:
+            days = self.retention.get(tier)
+            if days and day > today - days and \
+                    not os.path.exists(self.tier_path(tier, day)):
+                return False
+        return True
+
+    def run(self):
+        try:
+            # Only this thread, on Linux the priority is per thread
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            try:
+                self.compact()
+                self.expire()
+            except Exception as e:
+                self.logger.error('History compaction failed: %s' % str(e))
+            if self.stopped.wait(self.interval):
+                break
+
+    def compact(self):
+        today = int(time.time() // history.DAY)
+        for name in sorted(os.listdir(self.store.path)):
+            day = history.segment_day(name)
+            if day is None or day >= today or self.done(day):
+                continue
+            if self.stopped.is_set():
+                return
+            self.compact_day(day, os.path.join(self.store.path, name))
+
+    def records(self, path):
+        # Read the segment, pausing every batch records
+        count = 0
+        for record in history.scan(path, 0, float('inf')):
+            yield record
+            count += 1
+            if count % self.batch == 0:
+                time.sleep(self.pause)
+
+    def compact_day(self, day, path):
+        tiers = [t for t in TIERS if self.retention.get(t[0]) and
+                not os.path.exists(self.tier_path(t[0], day))]
+        rows = aggregate(self.records(path), [t[1] for t in tiers])
+        for (tier, width), tier_rows in zip(tiers, rows):
+            os.makedirs(os.path.join(self.store.path, tier), exist_ok=True)
+            atomic.write_file(self.tier_path(tier, day),
+                    b''.join(AGGREGATE.pack(*row) for row in tier_rows))
+            time.sleep(self.pause)
+        self.compacted += 1
+        self.logger.info('Compacted history for %s' % history.segment_name(day))
+
+    def expire(self):
+        today = int(time.time() // history.DAY)
+        for tier, width in TIERS:
+            days = self.retention.get(tier)
+            path = os.path.join(self.store.path, tier)
+            if not days or not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                day = history.segment_day(name)
+                if day is not None and day <= today - days:
+                    os.remove(os.path.join(path, name))
+
+    def days(self, first, last):
+        """
+        The compacted days from day first through day last, day -> the
+        tiers it has, finest first.
+        """
+        days = {}
+        for tier in TIERS:
+            path = os.path.join(self.store.path, tier[0])
+            for day in history.segment_days(path, first, last):
+                days.setdefault(day, []).append(tier)
+        return days
+
+    def read(self, day, tiers, sid, start, end, step):
+        """
+        Generate (time, min, max, sum, count) rows of a series for a day
+        from the coarsest of its tiers that is no coarser than step, or
+        the finest tier there is.
+        """
+        usable = [t for t in tiers if t[1] <= step]
+        tier = usable[-1] if usable else tiers[0]
+
+        for row in history.scan(self.tier_path(tier[0], day), start - tier[1] + 1,
+                end, AGGREGATE):
+            ts, rid, low, high, mean, count, last = row
+            if rid == sid:
+                yield ts, low, high, mean * count, count
+
+    def stop(self):
+        self.stopped.set()
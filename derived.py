@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Derived metrics, calculated from the values the weather software sends.
+
+A derived driver is configured by mapping it to 'derived' rather than to
+a field from the weather software:
+
+    temperature-dewpoint = derived
+    pressure-sealevel = derived
+    pressure-trend = derived
+
+Each metric declares its inputs.  As values arrive the inputs are
+updated and the metrics depending on a changed input are marked.  At the
+end of each upload the marked metrics are recalculated, in dependency
+order, using the formulas of the TemperatureNode and PressureNode.
+Copyright (c) 2018 Robert Paauwe
+"""
+import uom
+
+# Node values that are inputs to the metrics
+INPUTS = {
+        ('temperature', 'ST'): 'temperature',
+        ('humidity', 'ST'): 'humidity',
+        ('wind', 'ST'): 'windspeed',
+        ('pressure', 'ST'): 'pressure',
+        }
+
+# metric -> (node, driver, node method, inputs).  Inputs are either
+# from INPUTS, 'elevation' or another metric.
+METRICS = {
+        'dewpoint': ('temperature', 'GV0', 'Dewpoint',
+            ('temperature', 'humidity')),
+        'windchill': ('temperature', 'GV1', 'Windchill',
+            ('temperature', 'windspeed')),
+        'heatindex': ('temperature', 'GV2', 'Heatindex',
+            ('temperature', 'humidity')),
+        'apparent': ('temperature', 'GV3', 'ApparentTemp',
+            ('temperature', 'windspeed', 'humidity')),
+        'sealevel': ('pressure', 'GV0', 'toSeaLevel',
+            ('pressure', 'elevation')),
+        }
+
+# Values calculated by the node itself from the history of its own
+# values, metric -> node.
+NODE_METRICS = {
+        'trend': 'pressure',
+        }
+
+
+# The formulas want temperature in C, wind speed in m/s and pressure in
+# mb.  input -> (quantity, unit)
+FORMULA_UNITS = {
+        'temperature': ('temperature', 'C'),
+        'windspeed': ('speed', 'm/s'),
+        'pressure': ('pressure', 'mb'),
+        }
+
+# Results are converted back to the incoming units since the node's
+# setDriver converts from those to the display units. node -> (quantity,
+# unit)
+RESULT_UNITS = {
+        'temperature': ('temperature', 'C'),
+        'pressure': ('pressure', 'mb'),
+        }
+
+
+def formula_converters(units):
+    """
+    The converters from the incoming units (quantity -> unit) to the
+    formula units and back, None where no conversion is needed.
+    """
+    to_formula = {}
+    for name in FORMULA_UNITS:
+        quantity, unit = FORMULA_UNITS[name]
+        to_formula[name] = uom.converter(quantity, units[quantity], unit)
+    from_formula = {}
+    for kind in RESULT_UNITS:
+        quantity, unit = RESULT_UNITS[kind]
+        from_formula[kind] = uom.converter(quantity, unit, units[quantity])
+    return to_formula, from_formula
+
+
+def dependency_order(metrics):
+    """ Order the metrics so each comes after the metrics it uses. """
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError('Derived metric %s depends on itself' % name)
+        visiting.add(name)
+        for i in METRICS[name][3]:
+            if i in METRICS:
+                visit(i)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in sorted(metrics):
+        visit(name)
+    return order
+
+
+class DerivedMetrics(object):
+    """
+    Calculate the derived metrics for one station.  Only the dispatcher
+    thread of the station calls update() and flush().
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.values = {}
+        self.dirty = set()
+        self.state = ({}, {}, ())
+        self.to_formula = {}
+        self.from_formula = {}
+
+    def configure(self, metrics, address, units, elevation):
+        """
+        metrics is the set of derived metrics that are mapped, address a
+        function returning the station's node address for a node type and
+        units the incoming unit of each quantity.
+        """
+        order = dependency_order([m for m in metrics if m in METRICS])
+
+        inputs = {}
+        for kind, driver in INPUTS:
+            inputs[(address(kind), driver)] = INPUTS[(kind, driver)]
+
+        # input/metric -> metrics that need recalculating when it changes
+        depends = {}
+        plan = []
+        for name in order:
+            kind, driver, method, args = METRICS[name]
+            for i in args:
+                depends.setdefault(i, []).append(name)
+            plan.append((name, address(kind), kind, driver, method, args))
+
+        self.to_formula, self.from_formula = formula_converters(units)
+        self.values['elevation'] = elevation
+        self.dirty = set(order)
+        self.state = (inputs, depends, tuple(plan))
+
+    def update(self, address, driver, value):
+        inputs, depends, plan = self.state
+        name = inputs.get((address, driver))
+        if name is None or name not in depends:
+            return
+
+        convert = self.to_formula.get(name)
+        if convert is not None:
+            value = convert(value)
+        if self.values.get(name) == value:
+            return
+        self.values[name] = value
+        self.dirty.update(depends[name])
+
+    def flush(self, nodes):
+        """ Recalculate the metrics whose inputs changed. """
+        if not self.dirty:
+            return
+        inputs, depends, plan = self.state
+        values = self.values
+
+        for name, address, kind, driver, method, args in plan:
+            if name not in self.dirty:
+                continue
+            self.dirty.discard(name)
+            try:
+                node = nodes[address]
+                result = getattr(node, method)(*[values[i] for i in args])
+            except KeyError:
+                # not all inputs have been received yet
+                continue
+            except Exception as e:
+                self.logger.debug('Derived %s failed: %s' % (name, str(e)))
+                continue
+
+            if values.get(name) != result:
+                values[name] = result
+                self.dirty.update(depends.get(name, ()))
+            convert = self.from_formula.get(kind)
+            node.setDriver(driver, result if convert is None else convert(result))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Detect stations that stopped sending data and values that stopped
+updating.
+
+Each station's data processor keeps the time it last processed data and
+each node the time each of its drivers was last set.  Both are single
+assignments on the ingest path, no locks and nothing else to update.
+The controller's long poll checks them: a station that hasn't sent
+anything for timeout seconds is offline, a driver mapped to a field of
+the station's data that hasn't been set for timeout seconds while the
+station is online is stale.
+
+Derived values, statistics and rain totals only change when their
+inputs do so they aren't checked.
+Copyright (c) 2018 Robert Paauwe
+"""
+import time
+
+
+class FreshnessTracker(object):
+    """
+    Changes are logged once, when a station goes offline or comes back
+    and when a driver goes stale or is updated again.
+    """
+
+    def __init__(self, logger, timeout=900):
+        self.logger = logger
+        self.timeout = timeout
+        self.offline = set()
+        self.stale = set()
+
+    def configure(self, timeout):
+        """ timeout in seconds, 0 to not check """
+        self.timeout = timeout
+        if not timeout:
+            self.offline.clear()
+            self.stale.clear()
+
+    def check(self, stations, nodes, now=None):
+        """
+        Check the stations (id -> Station) and their nodes (address ->
+        node).  Returns the ids of the stations that came back online.
+        """
+        if not self.timeout:
+            return []
+        if now is None:
+            now = time.time()
+
+        online = []
+        stale = set()
+        for sid in stations:
+            station = stations[sid]
+            seen = station.processor.seen
+            if seen is None or now - seen > self.timeout:
+                if sid not in self.offline:
+                    self.offline.add(sid)
+                    self.logger.warning('No data from station %s for %d seconds' %
+                            (sid or 'default', self.timeout))
+                continue
+            if sid in self.offline:
+                self.offline.discard(sid)
+                self.logger.info('Station %s is sending data again' %
+                        (sid or 'default'))
+                online.append(sid)
+
+            for info in list(station.map.values()):
+                node = nodes.get(info['address'])
+                if info['units'] is None or node is None:
+                    continue
+                updated = node.updated.get(info['driver'])
+                if updated is None or now - updated > self.timeout:
+                    stale.add((info['address'], info['driver']))
+
+        # Stations that were removed
+        self.offline.intersection_update(stations)
+
+        # One line per node rather than per driver
+        new = {}
+        for address, driver in stale - self.stale:
+            new.setdefault(address, []).append(driver)
+        for address in sorted(new):
+            self.logger.warning('Node %s has not been updated for %d seconds: %s' %
+                    (address, self.timeout, ', '.join(sorted(new[address]))))
+        self.stale = stale
+        return online
+
+    def online(self):
+        """ True when every station is sending data """
+        return not self.offline
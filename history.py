@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Local history of the node values.
+
+Every value set on a node is recorded as a fixed size binary record
+(time stamp, series, value) in a segment file per (UTC) day.  A series
+is a node address and driver, the series ids are kept in a text file
+next to the segments with one 'address driver' line per id.
+
+Recording only appends to an in-memory queue.  A background thread
+writes the queued records every interval seconds, in time order, and
+syncs the files to disk every sync seconds.  Segments older than the
+retention period are deleted.  Segments are read through mmap, since
+the segments and the records in a segment are in time order, the days
+and then the start of a time range are found with a binary search.
+Copyright (c) 2018 Robert Paauwe
+"""
+import bisect
+import calendar
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+# time stamp, series id, value
+RECORD = struct.Struct('<dId')
+
+DAY = 24 * 60 * 60
+
+SERIES_FILE = 'series.txt'
+
+
+def segment_name(day):
+    """ File name of the segment for a day number (days since the epoch) """
+    return time.strftime('%Y%m%d', time.gmtime(day * DAY)) + '.dat'
+
+
+def segment_day(name):
+    """ Day number of a segment file name or None if it isn't a segment """
+    if not name.endswith('.dat'):
+        return None
+    try:
+        return calendar.timegm(time.strptime(name[:-4], '%Y%m%d')) // DAY
+    except ValueError:
+        return None
+
+
+def segment_days(path, first, last):
+    """
+    Sorted day numbers of the segments in a directory from day first
+    through day last.
+    """
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    days = sorted(d for d in map(segment_day, names) if d is not None)
+    return days[bisect.bisect_left(days, first):bisect.bisect_right(days, last)]
+
+
+def find(m, count, start, record=RECORD):
+    """ Index of the first record at or after start """
+    low = 0
+    high = count
+    while low < high:
+        mid = (low + high) // 2
+        if record.unpack_from(m, mid * record.size)[0] < start:
+            low = mid + 1
+        else:
+            high = mid
+    return low
+
+
+def scan(path, start, end, record=RECORD):
+    """
+    Generate the records, starting with a time stamp, of a time ordered
+    file that fall between start and end.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return
+    with f:
+        count = os.fstat(f.fileno()).st_size // record.size
+        if count == 0:
+            return
+        m = mmap.mmap(f.fileno(), count * record.size, access=mmap.ACCESS_READ)
+        try:
+            for i in range(find(m, count, start, record), count):
+                r = record.unpack_from(m, i * record.size)
+                if r[0] >= end:
+                    break
+                yield r
+        finally:
+            m.close()
+
+
+def downsample(rows, step):
+    """
+    Combine (time, min, max, sum, count) rows, in time order, into a
+    (time, min, mean, max, count) row for each step seconds.
+    """
+    current = None
+    for ts, low, high, total, count in rows:
+        slot = ts - (ts % step)
+        if slot != current:
+            if current is not None:
+                yield (current, s_low, s_total / s_count, s_high, s_count)
+            current = slot
+            s_low, s_high, s_total, s_count = low, high, total, count
+            continue
+        if low < s_low:
+            s_low = low
+        if high > s_high:
+            s_high = high
+        s_total += total
+        s_count += count
+    if current is not None:
+        yield (current, s_low, s_total / s_count, s_high, s_count)
+
+
+class HistoryStore(threading.Thread):
+
+    def __init__(self, logger, path='history', interval=5, sync=30,
+            pending=20000):
+        threading.Thread.__init__(self, name='weather-history')
+        self.daemon = True
+        self.logger = logger
+        self.path = path
+        self.interval = interval
+        self.sync = sync
+        self.days = 0
+        self.pending = collections.deque(maxlen=pending)
+        self.ids = {}
+        self.series = []
+        self.compactor = None
+        self.file = None
+        self.day = None
+        self.last = 0.0
+        self.synced = time.time()
+        self.written = 0
+        self.dropped = 0
+        self.stopped = threading.Event()
+
+    def configure(self, days):
+        """ Keep days of history, 0 turns recording off """
+        self.days = days
+
+    def record(self, address, driver, value):
+        if not self.days:
+            return
+        if len(self.pending) == self.pending.maxlen:
+            # The writer isn't keeping up, the oldest record is lost
+            self.dropped += 1
+        self.pending.append((time.time(), address, driver, value))
+
+    def run(self):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            self.load_series()
+        except OSError as e:
+            self.logger.error('History disabled, %s' % str(e))
+            self.days = 0
+            return
+
+        self.logger.info('Recording history in %s' % self.path)
+        while not self.stopped.wait(self.interval):
+            self.flush()
+        self.flush()
+        self.close()
+
+    def flush(self):
+        try:
+            self.write()
+        except Exception as e:
+            self.logger.error('Failed to write history: %s' % str(e))
+
+    def load_series(self):
+        path = os.path.join(self.path, SERIES_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                address, driver = line.split()
+                self.ids[(address, driver)] = len(self.series)
+                self.series.append((address, driver))
+
+    def series_id(self, address, driver):
+        key = (address, driver)
+        sid = self.ids.get(key)
+        if sid is None:
+            # The id has to be on disk before any record using it
+            with open(os.path.join(self.path, SERIES_FILE), 'a') as f:
+                f.write('%s %s\n' % key)
+                f.flush()
+                os.fsync(f.fileno())
+            sid = len(self.series)
+            self.series.append(key)
+            self.ids[key] = sid
+        return sid
+
+    def write(self):
+        batch = []
+        pending = self.pending
+        while pending:
+            batch.append(pending.popleft())
+        if not batch:
+            return
+        batch.sort(key=lambda r: r[0])
+
+        data = bytearray()
+        for ts, address, driver, value in batch:
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            # Keep each segment in time order
+            ts = max(ts, self.last)
+            day = int(ts // DAY)
+            if day != self.day:
+                self.write_segment(data)
+                data = bytearray()
+                self.open_segment(day)
+            data += RECORD.pack(ts, self.series_id(address, driver), value)
+            self.last = ts
+            self.written += 1
+        self.write_segment(data)
+
+        if self.file is not None and time.time() - self.synced >= self.sync:
+            self.synced = time.time()
+            os.fsync(self.file.fileno())
+
+    def write_segment(self, data):
+        if data and self.file is not None:
+            self.file.write(data)
+            self.file.flush()
+
+    def open_segment(self, day):
+        self.close()
+        path = os.path.join(self.path, segment_name(day))
+        self.file = open(path, 'ab')
+        # drop a partial record left by a crash
+        size = self.file.tell()
+        if size % RECORD.size:
+            self.file.truncate(size - size % RECORD.size)
+            self.file.seek(0, os.SEEK_END)
+        self.day = day
+        self.expire(day)
+
+    def close(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.synced = time.time()
+
+    def expire(self, today):
+        for name in os.listdir(self.path):
+            day = segment_day(name)
+            if day is not None and day <= today - self.days:
+                if self.compactor is not None and not self.compactor.done(day):
+                    # still needed for the compacted history
+                    continue
+                self.logger.info('Removing history segment %s' % name)
+                os.remove(os.path.join(self.path, name))
+
+    def query(self, address, driver, start, end, step):
+        """
+        Generate (time, min, max, sum, count) rows of a series.  Days
+        that no longer have their values come from the compacted history
+        when there is one.
+        """
+        sid = self.ids.get((address, driver))
+        if sid is None:
+            return
+        # Nothing is recorded before the epoch or in the future
+        start = max(start, 0.0)
+        end = min(end, time.time())
+        if start > end:
+            return
+        first = int(start // DAY)
+        last = int(end // DAY)
+
+        days = segment_days(self.path, first, last)
+        tiers = {}
+        if self.compactor is not None:
+            tiers = self.compactor.days(first, last)
+        raw = set(days)
+        for day in sorted(raw.union(tiers)):
+            if day in raw:
+                path = os.path.join(self.path, segment_name(day))
+                for ts, rid, value in scan(path, start, end):
+                    if rid == sid:
+                        yield ts, value, value, value, 1
+            else:
+                for row in self.compactor.read(day, tiers[day], sid,
+                        start, end, step):
+                    yield row
+
+    def stop(self):
+        # wait for the last records to be written
+        self.stopped.set()
+        if self.is_alive():
+            self.join(self.interval * 2)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Ingestion queue between the web server and the data processing.
+
+The HTTP handlers only place the raw request on the queue and return, a
+single dispatcher thread pulls requests off the queue and does all the
+parsing and driver updates.
+Copyright (c) 2018 Robert Paauwe
+"""
+import collections
+import threading
+
+# Overflow policies, what to do with a new request when the queue is full.
+DROP_OLDEST = 'oldest'
+DROP_NEWEST = 'newest'
+BLOCK = 'block'
+
+OVERFLOW = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class IngestQueue(object):
+    """
+    Bounded FIFO of raw requests.
+
+    When the queue is full, put() either discards the oldest queued item,
+    discards the new item or waits (up to block_timeout seconds) for the
+    dispatcher to make room, depending on the overflow policy.
+    """
+
+    def __init__(self, size=100, overflow=DROP_OLDEST, block_timeout=10):
+        if overflow not in OVERFLOW:
+            raise ValueError('Unknown queue overflow policy %s' % overflow)
+        self.size = max(1, int(size))
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.high_water = 0
+        self.closed = False
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    @property
+    def depth(self):
+        return len(self._items)
+
+    def put(self, item, block=True):
+        """
+        Queue an item, returns False if an item was dropped.  With block
+        False a full queue with the block policy drops the new item
+        rather than waiting.
+        """
+        with self._lock:
+            accepted = True
+            if len(self._items) >= self.size:
+                if self.overflow == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                    accepted = False
+                elif self.overflow == DROP_NEWEST or not block:
+                    self.dropped += 1
+                    return False
+                else:
+                    if not self._not_full.wait_for(
+                            lambda: len(self._items) < self.size or self.closed,
+                            self.block_timeout):
+                        self.dropped += 1
+                        return False
+
+            self._items.append(item)
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._not_empty.notify()
+            return accepted
+
+    def get(self, timeout=None):
+        """ Remove and return the oldest item, None on timeout or close. """
+        with self._lock:
+            if not self._not_empty.wait_for(
+                    lambda: self._items or self.closed, timeout):
+                return None
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+class Dispatcher(threading.Thread):
+    """
+    Thread that owns the parse -> map -> setDriver work.  Each item pulled
+    from the queue is passed to the process callback.
+    """
+
+    def __init__(self, queue, process, logger, name='weather-dispatch'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.queue = queue
+        self.process = process
+        self.logger = logger
+
+    def run(self):
+        while not self.queue.closed:
+            item = self.queue.get(timeout=1)
+            if item is None:
+                continue
+            try:
+                self.process(item)
+            except Exception as e:
+                self.logger.error('Failed to process data: {}'.format(e),
+                        exc_info=True)
+
+    def stop(self):
+        self.queue.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Compile the user's field mapping into parse plans.
+
+The mapping built by Controller.map_nodes holds, for each node value,
+the weather software field (a position in a space separated list or a
+query/key name) or an expression of fields.  Rather than walk that
+mapping on every request, it is compiled once into a plan for each type
+of source format:
+
+    fields - positional formats (MeteoBridge, WeeWX).  A tuple of
+             (field index, node address, driver, converter) entries
+             sorted by field index.
+    keys   - keyed formats (Cumulus, acuparse).  A dictionary of
+             key -> tuple of (node address, driver, converter), one for
+             each node value the key is mapped to.
+
+An expression is used for a value that contains spaces, operators or
+function calls, I.E. 'field7 * 0.1' or 'max(f3, f4)'.  Field names can
+contain '-', without spaces it's only a minus next to a field number,
+I.E. 'f7-f3' or '-f3'.  fN or fieldN is field N of a positional format,
+other names are keys.  Expressions can use + - * / // % **,
+parentheses, numbers and min(), max(), abs() and round().  Each one is
+compiled into a closure once:
+
+    field_exprs, key_exprs - tuples of (inputs, converters, function,
+             node address, driver) where function takes the list of
+             converted input values.
+
+Plans are never modified once built, a new plan is compiled and swapped
+in when the configuration changes.
+Copyright (c) 2018 Robert Paauwe
+"""
+import ast
+import collections
+import operator
+import re
+import types
+
+ParsePlan = collections.namedtuple('ParsePlan',
+        ['fields', 'keys', 'field_exprs', 'key_exprs', 'width'])
+
+# A field of a positional format in an expression
+FIELD_REF = re.compile(r'^f(?:ield)?(\d+)$')
+
+# Anything else is a field name
+EXPRESSION = re.compile(r'[\s*/+%(),]')
+
+# A minus next to a field number, without spaces
+FIELD_MINUS = re.compile(r'\bf(?:ield)?\d+-|-f(?:ield)?\d+\b')
+
+OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+        }
+
+FUNCTIONS = {
+        'min': min,
+        'max': max,
+        'abs': abs,
+        'round': round,
+        }
+
+# Cumulus sends the pressure trend as a string, map it to the I_TREND values
+TREND = {
+        'Falling': 0,
+        'Steady': 1,
+        'Rising': 2,
+        'Rising slowly': 3,
+        'Rising rapidly': 4,
+        'Falling slowly': 5,
+        'Falling rapidly': 6,
+        }
+TREND_UNKNOWN = 7
+
+CARDINAL = {d: i * 22.5 for i, d in enumerate([
+        "N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
+        "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"])}
+
+
+def to_trend(value):
+    return TREND.get(value, TREND_UNKNOWN)
+
+
+# convert cardinal direction to degrees
+def to_direction(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return CARDINAL[value]
+    except KeyError:
+        raise ValueError('Cannot convert ' + value + ' to degrees')
+
+
+def converter(node, driver):
+    """ Pick the function used to convert the raw string value. """
+    if node == 'pressure' and driver == 'GV1':
+        return to_trend
+    if node == 'wind' and driver in ('GV0', 'GV2', 'GV5'):
+        return to_direction
+    return float
+
+
+def compile_expression(text):
+    """
+    Compile an expression into a function of its input values.  Returns
+    (inputs, function), inputs are field numbers or key names in the
+    order function expects their values.  Raises ValueError if the
+    expression isn't valid.
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError('Invalid expression %s' % text)
+    inputs = []
+
+    def build(node):
+        if isinstance(node, ast.Constant) and \
+                type(node.value) in (int, float):
+            value = node.value
+            return lambda v: value
+
+        if isinstance(node, ast.Name):
+            match = FIELD_REF.match(node.id)
+            ref = int(match.group(1)) if match else node.id
+            if ref not in inputs:
+                inputs.append(ref)
+            i = inputs.index(ref)
+            return lambda v: v[i]
+
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            op = OPERATORS[type(node.op)]
+            left = build(node.left)
+            right = build(node.right)
+            return lambda v: op(left(v), right(v))
+
+        if isinstance(node, ast.UnaryOp) and \
+                isinstance(node.op, (ast.UAdd, ast.USub)):
+            operand = build(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda v: -operand(v)
+            return operand
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+                and node.func.id in FUNCTIONS and node.args \
+                and not node.keywords:
+            function = FUNCTIONS[node.func.id]
+            args = [build(a) for a in node.args]
+            return lambda v: function(*[a(v) for a in args])
+
+        raise ValueError('Invalid expression %s' % text)
+
+    function = build(tree.body)
+    if not inputs:
+        raise ValueError('Expression %s does not use any fields' % text)
+    if len(set(type(i) for i in inputs)) > 1:
+        raise ValueError('Expression %s mixes field numbers and names' % text)
+    return tuple(inputs), function
+
+
+def compile_source(text):
+    """
+    The (inputs, function) of an expression or None if text is a plain
+    field.  Raises ValueError if the expression isn't valid.
+    """
+    if not EXPRESSION.search(text) and not FIELD_MINUS.search(text):
+        return None
+    return compile_expression(text)
+
+
+def compile_plan(node_map):
+    fields = []
+    keys = {}
+    field_exprs = []
+    key_exprs = []
+
+    for name in node_map:
+        m = node_map[name]
+        source = m['source']
+        expr = compile_source(source)
+        if expr is None:
+            keys.setdefault(source, []).append((m['address'], m['driver'],
+                converter(m['node'], m['driver'])))
+            # positional formats are always numeric
+            try:
+                fields.append((int(source), m['address'], m['driver'], float))
+            except ValueError:
+                pass
+            continue
+
+        inputs, function = expr
+        entry = (inputs, (float,) * len(inputs), function, m['address'],
+                m['driver'])
+        if isinstance(inputs[0], int):
+            field_exprs.append(entry)
+        else:
+            key_exprs.append(entry)
+            # Keys only used in expressions aren't unmapped
+            for key in inputs:
+                keys.setdefault(key, [])
+
+    fields.sort(key=lambda f: f[0])
+    width = 0
+    if fields:
+        width = fields[-1][0] + 1
+    for inputs, converters, function, address, driver in field_exprs:
+        width = max(width, max(inputs) + 1)
+
+    for key in keys:
+        keys[key] = tuple(keys[key])
+    return ParsePlan(tuple(fields), types.MappingProxyType(keys),
+            tuple(field_exprs), tuple(key_exprs), width)
+
+
+EMPTY_PLAN = compile_plan({})
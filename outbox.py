@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Hold driver updates while the connection to Polyglot is down.
+
+Only the latest value of each driver is kept so the memory used depends
+on the number of drivers, not on how long the connection is down.  When
+the connection is back the held values are sent, at most rate per
+second, by a background thread.  New values for drivers that are still
+waiting replace the waiting value so the ISY ends up with the latest.
+
+Optionally the held values are also written to a file, every few
+seconds while there are any, so they survive a restart.
+Copyright (c) 2018 Robert Paauwe
+"""
+import json
+import os
+import threading
+import time
+import atomic
+
+
+class Outbox(threading.Thread):
+    """
+    connected() returns True when updates can be sent, send(address,
+    driver, value) sends one update.
+    """
+
+    def __init__(self, connected, send, logger, rate=20, path=None):
+        threading.Thread.__init__(self, name='weather-outbox')
+        self.daemon = True
+        self.connected = connected
+        self.send = send
+        self.logger = logger
+        self.rate = rate
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.dirty = False
+        # a batch taken out of pending is being sent
+        self.replaying = False
+        self.saved = 0
+        self.held = 0
+        self.replayed = 0
+        self.stopped = threading.Event()
+
+    def configure(self, rate, path):
+        self.rate = max(1, rate)
+        self.path = path
+
+    def holding(self):
+        """ True if updates have to wait, to keep them in order """
+        return bool(self.pending) or self.replaying or not self.connected()
+
+    def hold(self, address, driver, value):
+        with self.lock:
+            self.pending[(address, driver)] = value
+            self.dirty = True
+        self.held += 1
+
+    def run(self):
+        self.load()
+        while not self.stopped.wait(1):
+            if self.pending and self.connected():
+                self.replay()
+            if self.dirty and time.time() - self.saved >= 5:
+                self.save()
+
+    def replay(self):
+        with self.lock:
+            count = len(self.pending)
+        self.logger.info('Sending %d held driver updates' % count)
+
+        # Newer updates have to wait until the older ones are sent
+        self.replaying = True
+        try:
+            self.send_pending()
+        finally:
+            self.replaying = False
+        self.save()
+
+    def send_pending(self):
+        while self.pending and not self.stopped.is_set():
+            start = time.time()
+            with self.lock:
+                batch = []
+                for key in list(self.pending)[:self.rate]:
+                    batch.append((key, self.pending.pop(key)))
+                self.dirty = True
+
+            for i, (key, value) in enumerate(batch):
+                try:
+                    self.send(key[0], key[1], value)
+                    self.replayed += 1
+                except Exception as e:
+                    self.logger.warning('Send failed, holding updates: %s' % str(e))
+                    with self.lock:
+                        # keep anything newer that arrived meanwhile
+                        for k, v in batch[i:]:
+                            self.pending.setdefault(k, v)
+                    return
+
+            # rate limit
+            wait = 1.0 - (time.time() - start)
+            if wait > 0 and self.pending:
+                self.stopped.wait(wait)
+
+    def save(self):
+        self.saved = time.time()
+        if not self.path:
+            self.dirty = False
+            return
+        with self.lock:
+            data = [[k[0], k[1], v] for k, v in self.pending.items()]
+            self.dirty = False
+        try:
+            atomic.write_file(self.path, json.dumps(data).encode())
+        except (OSError, TypeError, ValueError) as e:
+            self.logger.error('Failed to save held updates: %s' % str(e))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.error('Failed to read held updates: %s' % str(e))
+            return
+        with self.lock:
+            for address, driver, value in data:
+                self.pending.setdefault((address, driver), value)
+        if data:
+            self.logger.info('Loaded %d held driver updates' % len(data))
+
+    def stop(self):
+        self.stopped.set()
+        if self.dirty:
+            self.save()
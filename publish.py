@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""
+Filter driver updates before they are published to the ISY.
+
+Most of the values sent by the weather software don't change from one
+upload to the next.  The publish filter only lets a driver update through
+when it has moved outside its deadband since the last published value or
+when the driver hasn't been published for max_silence seconds.
+
+Updates can also be coalesced over a short flush window so that only the
+latest value of each driver is published, one node at a time.
+
+The publish scheduler limits how often each driver is published and,
+when more updates are waiting than the publish rate allows, sends the
+highest priority ones first.
+Copyright (c) 2018 Robert Paauwe
+"""
+import threading
+import time
+import write_profile
+
+# Publish priorities, higher is sent first
+PRIORITIES = {
+        'low' : 1,
+        'normal' : 2,
+        'high' : 3,
+        }
+
+# (minimum interval, maximum interval, priority) of drivers that don't
+# have a policy.  A maximum interval of None uses MaxSilence.
+DEFAULT_POLICY = (0, None, PRIORITIES['normal'])
+
+# Drivers holding compass directions, the deadband wraps around at 360.
+CIRCULAR = {
+        ('wind', 'GV0'),
+        ('wind', 'GV2'),
+        ('wind', 'GV5'),
+        }
+
+
+def parse_deadbands(text):
+    """
+    Parse the Deadband configuration parameter.  This is a comma separated
+    list of node-value=deadband entries.  A deadband ending in % is
+    relative to the last published value, otherwise it is absolute.
+
+        temperature-main=0.1, wind-winddir=1, pressure-station=0.05%
+
+    Returns a dictionary of (node, driver) -> (absolute, relative).
+    """
+    deadbands = {}
+    if not text:
+        return deadbands
+
+    for entry in str(text).split(','):
+        entry = entry.strip()
+        if entry == '':
+            continue
+        try:
+            name, band = entry.split('=')
+            node, value = name.strip().split('-')
+            driver = write_profile.NODE_DRVS[node][value]
+        except (ValueError, KeyError):
+            raise ValueError('Invalid deadband entry %s' % entry)
+
+        band = band.strip()
+        if band.endswith('%'):
+            deadbands[(node, driver)] = (0.0, float(band[:-1]) / 100.0)
+        else:
+            deadbands[(node, driver)] = (float(band), 0.0)
+
+    return deadbands
+
+
+def parse_policies(text):
+    """
+    Parse the PublishPolicy configuration parameter.  This is a comma
+    separated list of node=policy or node-value=policy entries where the
+    policy is min/max/priority:
+
+        wind-windspeed=0/60/high, rain=60, temperature-soil=300/3600/low
+
+    min is the minimum number of seconds between updates, max the number
+    of seconds after which an unchanged value is sent again (replaces
+    MaxSilence) and priority is low, normal, high or a number.  Fields
+    that are left out keep the node type's default.
+
+    Returns a dictionary of (node, driver or None) -> (min, max, priority)
+    with None for the fields that weren't given.
+    """
+    policies = {}
+    if not text:
+        return policies
+
+    for entry in str(text).split(','):
+        entry = entry.strip()
+        if entry == '':
+            continue
+        try:
+            name, policy = entry.split('=')
+            name = name.strip()
+            if '-' in name:
+                node, value = name.split('-')
+                driver = write_profile.NODE_DRVS[node][value]
+            else:
+                node = name
+                driver = None
+                write_profile.NODE_DRVS[node]
+            fields = [f.strip() for f in policy.split('/')]
+            if len(fields) > 3:
+                raise ValueError()
+            fields += [''] * (3 - len(fields))
+            low = float(fields[0]) if fields[0] else None
+            high = float(fields[1]) if fields[1] else None
+            if fields[2] in PRIORITIES:
+                priority = PRIORITIES[fields[2]]
+            else:
+                priority = int(fields[2]) if fields[2] else None
+        except (ValueError, KeyError):
+            raise ValueError('Invalid publish policy %s' % entry)
+
+        policies[(node, driver)] = (low, high, priority)
+
+    return policies
+
+
+class PublishFilter(object):
+    """
+    Per driver deadband and change-only publishing.
+
+    Drivers without a configured deadband are published only when their
+    value changes.  A max_silence of 0 disables the forced refresh.
+
+    Every station's dispatcher and the coalescer call accept while the
+    configuration thread resets or forgets nodes, the history is only
+    used with the lock held.
+    """
+
+    def __init__(self, deadbands=None, max_silence=0):
+        self.deadbands = deadbands if deadbands else {}
+        self.max_silence = max_silence
+        self.last = {}
+        self.published = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def configure(self, deadbands, max_silence):
+        with self.lock:
+            self.deadbands = deadbands
+            self.max_silence = max_silence
+
+    def counts(self):
+        """ (published, suppressed) """
+        with self.lock:
+            return (self.published, self.suppressed)
+
+    def changed(self, kind, driver, old, new):
+        try:
+            delta = abs(new - old)
+        except TypeError:
+            return new != old
+
+        if (kind, driver) in CIRCULAR:
+            delta = delta % 360
+            delta = min(delta, 360 - delta)
+
+        absolute, relative = self.deadbands.get((kind, driver), (0.0, 0.0))
+        if relative:
+            return delta > abs(old) * relative
+        if absolute:
+            return delta > absolute
+        return delta != 0
+
+    def accept(self, address, kind, driver, value, now=None, silence=None):
+        """
+        Returns True if the value should be published.  address is the
+        node address, kind is the node name used in the configuration.
+        silence replaces max_silence for this driver.
+        """
+        if now is None:
+            now = time.time()
+        key = (address, driver)
+        with self.lock:
+            if silence is None:
+                silence = self.max_silence
+            last = self.last.get(key)
+
+            if last is not None and \
+                    not self.changed(kind, driver, last[0], value) and \
+                    (silence <= 0 or now - last[1] < silence):
+                self.suppressed += 1
+                return False
+
+            self.last[key] = (value, now)
+            self.published += 1
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.last.clear()
+
+    def forget(self, address):
+        """ Drop the history for a node so its next update is published. """
+        with self.lock:
+            for key in [k for k in self.last if k[0] == address]:
+                del self.last[key]
+
+
+class Coalescer(object):
+    """
+    Collect driver updates over a flush window and publish them a node
+    at a time.  Only the latest value for each node/driver is kept, so a
+    burst of updates for the same driver results in a single publish.
+
+    A window of 0 disables coalescing.  A window of None means the flush
+    is driven from outside (the controller's shortPoll).
+    """
+
+    def __init__(self, logger, window=0):
+        self.logger = logger
+        self.window = window
+        self.pending = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.window != 0
+
+    def configure(self, window):
+        self.window = window
+        if window:
+            self.start()
+        else:
+            # Going back to publishing immediately, don't leave
+            # anything behind.
+            self.flush()
+
+    def add(self, node, driver, value):
+        with self.lock:
+            updates = self.pending.get(node)
+            if updates is None:
+                self.pending[node] = {driver: value}
+            else:
+                if driver in updates:
+                    self.coalesced += 1
+                updates[driver] = value
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = {}
+
+        for node in pending:
+            try:
+                node.publish_batch(pending[node])
+            except Exception as e:
+                self.logger.error('Failed to publish {} updates: {}'.format(
+                    node.address, e))
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='weather-flush')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            # Window may be changed or switched to shortPoll while running
+            window = self.window
+            if not window:
+                break
+            self.stopped.wait(window)
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
+
+
+class PublishScheduler(object):
+    """
+    Per driver publish rate limits and priorities.
+
+    Each node type declares the policy, (minimum interval, maximum
+    interval, priority), of its drivers in publish_policy, keyed by
+    driver with None for the node's default.  The PublishPolicy
+    parameter overrides them.
+
+    A driver is published at most once every minimum interval seconds,
+    a value arriving sooner waits, only the latest value is kept, until
+    the interval is up.  When rate is set, at most rate updates are
+    published per second; when more are waiting, the highest priority
+    ones go first and the rest wait for the next second.
+    """
+
+    def __init__(self, logger, deliver, rate=0, tick=0.25):
+        self.logger = logger
+        self.deliver = deliver
+        self.rate = rate
+        self.tick = tick
+        self.overrides = {}
+        self.policies = {}
+        self.pending = {}
+        self.last = {}
+        self.second = 0
+        self.count = 0
+        self.deferred = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def configure(self, overrides, rate):
+        self.overrides = overrides
+        self.rate = max(0, rate)
+        self.policies = {}
+
+    def policy(self, node, driver):
+        key = (node.kind, driver)
+        policy = self.policies.get(key)
+        if policy is None:
+            declared = node.publish_policy
+            policy = list(declared.get(driver, declared.get(None, DEFAULT_POLICY)))
+            for override in ((node.kind, None), key):
+                for i, field in enumerate(self.overrides.get(override, ())):
+                    if field is not None:
+                        policy[i] = field
+            policy = tuple(policy)
+            self.policies[key] = policy
+        return policy
+
+    def take(self, now):
+        # One publish out of this second's rate
+        if not self.rate:
+            return True
+        second = int(now)
+        if second != self.second:
+            self.second = second
+            self.count = 0
+        if self.count >= self.rate:
+            return False
+        self.count += 1
+        return True
+
+    def submit(self, node, driver, value, now=None):
+        """
+        Returns True if the update can be published now, otherwise it
+        waits and is delivered later.
+        """
+        if now is None:
+            now = time.time()
+        interval, silence, priority = self.policy(node, driver)
+        key = (node.address, driver)
+        with self.lock:
+            if key in self.pending:
+                self.pending[key] = (priority, node, value)
+                return False
+            if (interval and now - self.last.get(key, 0) < interval) or \
+                    (self.pending and self.rate) or not self.take(now):
+                self.pending[key] = (priority, node, value)
+                self.deferred += 1
+                self.start()
+                return False
+            self.last[key] = now
+        return True
+
+    def due(self, now, everything=False):
+        """ Take the waiting updates that can be published now """
+        with self.lock:
+            ready = []
+            for key, (priority, node, value) in self.pending.items():
+                interval = self.policy(node, key[1])[0]
+                if everything or not interval or \
+                        now - self.last.get(key, 0) >= interval:
+                    ready.append((priority, key))
+            ready.sort(key=lambda r: -r[0])
+
+            updates = []
+            for priority, key in ready:
+                if not everything and not self.take(now):
+                    break
+                priority, node, value = self.pending.pop(key)
+                self.last[key] = now
+                updates.append((node, key[1], value))
+        return updates
+
+    def flush(self, everything=False):
+        for node, driver, value in self.due(time.time(), everything):
+            try:
+                self.deliver(node, driver, value)
+            except Exception as e:
+                self.logger.error('Failed to publish {} {}: {}'.format(
+                    node.address, driver, e))
+
+    def start(self):
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='weather-schedule')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.tick):
+            self.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.flush(True)
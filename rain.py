@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Rain accumulation.
+
+Weather software doesn't always send the hourly, daily, weekly, monthly
+and yearly rain totals.  These can be calculated by the node server
+from either the station's rain counter (a running total that only
+resets when the station restarts) or the rain since the last report:
+
+    rain-total = <field>        (cumulative counter)
+    rain-increment = <field>    (rain since the last report)
+    rain-daily = derived
+    rain-yesterday = derived
+    rain-maxrate = derived      (highest rain-rate today)
+
+Periods roll over in the local time zone (daylight saving time aware),
+the week starts on Sunday.  The time of the next rollover is kept so
+each update is a comparison and a few additions.  The totals are saved
+with the node server's custom data so they survive a restart.
+Copyright (c) 2018 Robert Paauwe
+"""
+import datetime
+import threading
+import time
+
+# Mapping keys that feed the accumulator rather than a driver
+INPUTS = ('total', 'increment')
+
+PERIODS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+# Values the accumulator can fill
+OUTPUTS = PERIODS + ('yesterday', 'maxrate')
+
+
+def period_keys(now):
+    """ The local hour, day, week, month and year the time falls in """
+    dt = datetime.datetime.fromtimestamp(now)
+    day = dt.date()
+    week = day - datetime.timedelta(days=(day.weekday() + 1) % 7)
+    return [
+            [dt.year, dt.month, dt.day, dt.hour],
+            [dt.year, dt.month, dt.day],
+            [week.year, week.month, week.day],
+            [dt.year, dt.month],
+            [dt.year],
+            ]
+
+
+def next_hour(now):
+    """ Time stamp of the start of the next local hour """
+    dt = datetime.datetime.fromtimestamp(now).replace(minute=0, second=0,
+            microsecond=0)
+    return time.mktime((dt + datetime.timedelta(hours=1)).timetuple())
+
+
+class RainAccumulator(object):
+    """
+    Rain totals for one station.  update() and flush() are called by the
+    station's dispatcher thread, state() by the controller when saving.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.address = None
+        self.outputs = {}
+        self.totals = [0.0] * len(PERIODS)
+        self.keys = [None] * len(PERIODS)
+        self.yesterday = 0.0
+        self.maxrate = 0.0
+        self.counter = None
+        self.rollover = 0
+        self.dirty = False
+        self.changed = False
+
+    def configure(self, derived_map, address):
+        """ Publish the rain values mapped to 'derived' """
+        outputs = {}
+        for name in OUTPUTS:
+            info = derived_map.get(name)
+            if info is not None and info['node'] == 'rain':
+                outputs[name] = info['driver']
+        self.address = address('rain')
+        self.outputs = outputs
+        self.dirty = True
+
+    def roll(self, now):
+        keys = period_keys(now)
+        if keys[1] != self.keys[1]:
+            # yesterday is only known if the previous day was yesterday
+            prev = datetime.date.fromtimestamp(now) - datetime.timedelta(days=1)
+            if self.keys[1] == [prev.year, prev.month, prev.day]:
+                self.yesterday = self.totals[1]
+            else:
+                self.yesterday = 0.0
+            self.maxrate = 0.0
+        for i in range(len(PERIODS)):
+            if keys[i] != self.keys[i]:
+                self.keys[i] = keys[i]
+                self.totals[i] = 0.0
+        self.rollover = next_hour(now)
+        self.dirty = True
+
+    def update(self, address, driver, value, now=None):
+        if address != self.address or not self.outputs:
+            return
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            if now >= self.rollover:
+                self.roll(now)
+
+            if driver == 'total':
+                if self.counter is None:
+                    rain = 0.0
+                elif value < self.counter:
+                    # The counter was reset, count from zero
+                    rain = value
+                else:
+                    rain = value - self.counter
+                self.counter = value
+            elif driver == 'increment':
+                rain = value
+            elif driver == 'ST':
+                if value > self.maxrate:
+                    self.maxrate = value
+                    self.dirty = True
+                    self.changed = True
+                return
+            else:
+                return
+
+            if rain > 0:
+                for i in range(len(self.totals)):
+                    self.totals[i] += rain
+                self.dirty = True
+            self.changed = True
+
+    def flush(self, nodes):
+        if not self.dirty or self.address not in nodes:
+            return
+        self.dirty = False
+        node = nodes[self.address]
+        for name in self.outputs:
+            if name == 'yesterday':
+                value = self.yesterday
+            elif name == 'maxrate':
+                value = self.maxrate
+            else:
+                value = self.totals[PERIODS.index(name)]
+            node.setDriver(self.outputs[name], round(value, 3))
+
+    def state(self):
+        """ The totals to save, or None if nothing changed since the last save """
+        with self.lock:
+            if not self.changed:
+                return None
+            self.changed = False
+            return {
+                    'totals': list(self.totals),
+                    'keys': list(self.keys),
+                    'yesterday': self.yesterday,
+                    'maxrate': self.maxrate,
+                    'counter': self.counter,
+                    }
+
+    def restore(self, state):
+        try:
+            totals = [float(t) for t in state['totals']]
+            keys = [list(k) if k is not None else None for k in state['keys']]
+            yesterday = float(state['yesterday'])
+            maxrate = float(state['maxrate'])
+            counter = state['counter']
+        except (KeyError, TypeError, ValueError):
+            return False
+        if len(totals) != len(PERIODS) or len(keys) != len(PERIODS):
+            return False
+
+        with self.lock:
+            self.totals = totals
+            self.keys = keys
+            self.yesterday = yesterday
+            self.maxrate = maxrate
+            self.counter = counter
+            # Catch up on any rollovers that happened while stopped
+            self.rollover = 0
+            self.dirty = True
+        return True
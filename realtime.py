@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Watch local realtime data files written by the weather software.
+
+When the weather software runs on the same machine as the node server,
+it can be configured to write its realtime file (Cumulus realtime.txt,
+Weather Display clientraw.txt) rather than push the data over HTTP.
+Both are space separated lists of values, mapped by field position just
+like MeteoBridge and WeeWX data.
+
+The files are checked with a stat() every interval seconds and only read
+(with a single read) when the modification time or size changed.
+Copyright (c) 2018 Robert Paauwe
+"""
+import os
+import threading
+
+
+class FileWatcher(threading.Thread):
+    """
+    Poll the configured files and queue the contents of any that changed
+    on the ingest queue of the station it belongs to.
+    """
+
+    def __init__(self, logger, interval=2):
+        threading.Thread.__init__(self, name='weather-realtime')
+        self.daemon = True
+        self.logger = logger
+        self.interval = interval
+        self.files = {}
+        self.seen = {}
+        self.missing = set()
+        self.stopped = threading.Event()
+
+    def configure(self, files, interval):
+        """ files is a dictionary of file path -> ingest queue """
+        self.files = files
+        self.interval = interval
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            files = self.files
+            for path in files:
+                try:
+                    self.check(path, files[path])
+                except Exception as e:
+                    self.logger.error('Failed to read {}: {}'.format(path, e))
+
+    def check(self, path, queue):
+        try:
+            st = os.stat(path)
+        except OSError:
+            if path not in self.missing:
+                self.logger.warning('Realtime file %s not found' % path)
+                self.missing.add(path)
+            return
+        self.missing.discard(path)
+
+        signature = (st.st_mtime_ns, st.st_size)
+        if self.seen.get(path) == signature or st.st_size == 0:
+            return
+        self.seen[path] = signature
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        queue.put(('realtime', data))
+
+    def stop(self):
+        self.stopped.set()
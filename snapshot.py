@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Snapshot of the node server's runtime state for a warm restart.
+
+The last driver values (with their uom and when they were set), the
+pressure trend history and the statistics windows are saved every long
+poll and when the node server stops.  They're restored when it starts,
+before the web server accepts data, so the ISY doesn't see every value
+drop to 0 and the trend and statistics don't start over.  A value whose
+driver uom changed in the meantime isn't restored.  The rain totals
+are kept in the custom data instead.
+
+The snapshot is a pickle of plain lists and dictionaries, written with
+atomic.write_file so a crash while saving leaves the previous snapshot
+intact.
+Copyright (c) 2018 Robert Paauwe
+"""
+import os
+import pickle
+import atomic
+
+VERSION = 2
+
+SNAPSHOT_FILE = 'snapshot.dat'
+
+
+def save(state, path=SNAPSHOT_FILE):
+    atomic.write_file(path, pickle.dumps((VERSION, state),
+        protocol=pickle.HIGHEST_PROTOCOL))
+
+
+# Sections of the saved state, each a dictionary
+SECTIONS = ('nodes', 'trend', 'stats')
+
+
+def load(logger, path=SNAPSHOT_FILE):
+    """ The saved state, or None if there isn't a usable snapshot """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            version, state = pickle.load(f)
+        if version != VERSION:
+            raise ValueError('version %s' % str(version))
+        for section in SECTIONS:
+            if not isinstance(state[section], dict):
+                raise ValueError('bad %s' % section)
+    except Exception as e:
+        # A damaged snapshot must never keep the node server from starting
+        logger.error('Ignoring snapshot %s: %s' % (path, str(e)))
+        return None
+    return state
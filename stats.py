@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Rolling window statistics (min, max, mean, sum) of node values.
+
+The maximum/minimum temperature, wind lull, average wind speed and
+direction and wind gust can be calculated by the node server rather
+than sent by the weather software.  They are configured by mapping them to 'derived', optionally
+followed by the window to use:
+
+    temperature-max = derived          (since midnight)
+    wind-avgwindspeed = derived:10m
+    wind-lullspeed = derived:1h
+
+Sliding windows are split into a fixed number of buckets so memory use
+doesn't depend on how often the station uploads.  Min and max are kept
+with monotonic deques of the bucket min/max, sum and count are updated
+incrementally as buckets enter and leave the window.  'daily' windows
+(since midnight) only need running totals.
+
+Wind direction can't be averaged as a number (the average of 350 and 10
+degrees is north, not south).  It is averaged as a vector, keeping sums
+of the speed weighted sine and cosine of the direction.  The gust is the
+highest speed in the window and the direction it came from.
+Copyright (c) 2018 Robert Paauwe
+"""
+import collections
+import datetime
+import math
+import threading
+import time
+
+# node, value -> (source node, source driver, statistic, default window).
+# A source driver of None is the wind vector (speed and direction).
+STATISTICS = {
+        ('temperature', 'max'): ('temperature', 'ST', 'max', 'daily'),
+        ('temperature', 'min'): ('temperature', 'ST', 'min', 'daily'),
+        ('wind', 'lullspeed'): ('wind', 'ST', 'min', '10m'),
+        ('wind', 'avgwindspeed'): ('wind', 'ST', 'mean', '10m'),
+        ('wind', 'avgwinddir'): ('wind', None, 'direction', '10m'),
+        ('wind', 'gustspeed'): ('wind', None, 'gust', '10m'),
+        ('wind', 'gustdir'): ('wind', None, 'gustdir', '10m'),
+        }
+
+# wind node speed and direction drivers
+WIND_SPEED = 'ST'
+WIND_DIR = 'GV0'
+
+DAILY = 'daily'
+
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_window(text):
+    """ Window as 'daily' or a number followed by s, m, h or d """
+    text = text.strip().lower()
+    if text == DAILY:
+        return DAILY
+    try:
+        if text[-1] in UNITS:
+            seconds = float(text[:-1]) * UNITS[text[-1]]
+        else:
+            seconds = float(text)
+    except (ValueError, IndexError):
+        raise ValueError('Invalid statistics window %s' % text)
+    if seconds <= 0:
+        raise ValueError('Invalid statistics window %s' % text)
+    return seconds
+
+
+class RollingWindow(object):
+    """ Statistics over the last window seconds. """
+
+    def __init__(self, window, buckets=120):
+        self.window = window
+        self.width = float(window) / buckets
+        # [bucket start, min, max, sum, count]
+        self.buckets = collections.deque()
+        self.mins = collections.deque()
+        self.maxs = collections.deque()
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value, now=None):
+        if now is None:
+            now = time.time()
+
+        start = now - (now % self.width)
+        if self.buckets and self.buckets[-1][0] == start:
+            bucket = self.buckets[-1]
+            bucket[3] += value
+            bucket[4] += 1
+        else:
+            bucket = [start, value, value, value, 1]
+            self.buckets.append(bucket)
+        self.total += value
+        self.count += 1
+
+        if value <= bucket[1]:
+            bucket[1] = value
+            while self.mins and self.mins[-1][1] >= value:
+                self.mins.pop()
+            self.mins.append((start, value))
+        if value >= bucket[2]:
+            bucket[2] = value
+            while self.maxs and self.maxs[-1][1] <= value:
+                self.maxs.pop()
+            self.maxs.append((start, value))
+
+        self.expire(now)
+
+    def update(self, driver, value):
+        self.add(value)
+
+    def commit(self, now=None):
+        pass
+
+    def state(self):
+        return (self.width, [list(b) for b in self.buckets], list(self.mins),
+                list(self.maxs), self.total, self.count)
+
+    def restore(self, state):
+        width, buckets, mins, maxs, total, count = state
+        if width != self.width:
+            return False
+        self.buckets = collections.deque([list(b) for b in buckets])
+        self.mins = collections.deque(mins)
+        self.maxs = collections.deque(maxs)
+        self.total = total
+        self.count = count
+        return True
+
+    def expire(self, now):
+        cutoff = now - self.window
+        while self.buckets and self.buckets[0][0] + self.width <= cutoff:
+            old = self.buckets.popleft()
+            self.total -= old[3]
+            self.count -= old[4]
+            if self.mins and self.mins[0][0] == old[0]:
+                self.mins.popleft()
+            if self.maxs and self.maxs[0][0] == old[0]:
+                self.maxs.popleft()
+
+    def min(self):
+        return self.mins[0][1] if self.mins else None
+
+    def max(self):
+        return self.maxs[0][1] if self.maxs else None
+
+    def sum(self):
+        return self.total
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class DailyWindow(object):
+    """ Statistics since local midnight. """
+
+    def __init__(self):
+        self.day = None
+        self.low = None
+        self.high = None
+        self.total = 0.0
+        self.count = 0
+
+    def add(self, value, now=None):
+        if now is None:
+            now = time.time()
+        day = datetime.date.fromtimestamp(now)
+        if day != self.day:
+            self.day = day
+            self.low = self.high = value
+            self.total = 0.0
+            self.count = 0
+
+        if value < self.low:
+            self.low = value
+        if value > self.high:
+            self.high = value
+        self.total += value
+        self.count += 1
+
+    def update(self, driver, value):
+        self.add(value)
+
+    def commit(self, now=None):
+        pass
+
+    def state(self):
+        day = self.day.toordinal() if self.day is not None else None
+        return (day, self.low, self.high, self.total, self.count)
+
+    def restore(self, state):
+        day, self.low, self.high, self.total, self.count = state
+        self.day = datetime.date.fromordinal(day) if day is not None else None
+        return True
+
+    def min(self):
+        return self.low
+
+    def max(self):
+        return self.high
+
+    def sum(self):
+        return self.total
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+class WindWindow(object):
+    """
+    Vector average of the wind direction and the gust over the last
+    window seconds.  Speed and direction arrive as separate values, the
+    pair is added as one sample when the upload is complete.  An upload
+    with only one of them isn't a sample, pairing it with an older value
+    of the other would count that value twice.
+    """
+
+    def __init__(self, window, buckets=120):
+        self.window = window
+        self.width = float(window) / buckets
+        self.speed = None
+        self.heading = None
+        # [bucket start, sum x, sum y, gust speed, gust direction]
+        self.buckets = collections.deque()
+        self.gusts = collections.deque()
+        self.x = 0.0
+        self.y = 0.0
+
+    def update(self, driver, value):
+        if driver == WIND_SPEED:
+            self.speed = value
+        elif driver == WIND_DIR:
+            self.heading = value
+
+    def commit(self, now=None):
+        speed, heading = self.speed, self.heading
+        self.speed = None
+        self.heading = None
+        if speed is None or heading is None:
+            return
+        self.add(speed, heading, now)
+
+    def state(self):
+        return (self.width, self.speed, self.heading,
+                [list(b) for b in self.buckets], list(self.gusts),
+                self.x, self.y)
+
+    def restore(self, state):
+        width, speed, heading, buckets, gusts, x, y = state
+        if width != self.width:
+            return False
+        self.speed = speed
+        self.heading = heading
+        self.buckets = collections.deque([list(b) for b in buckets])
+        self.gusts = collections.deque(gusts)
+        self.x = x
+        self.y = y
+        return True
+
+    def add(self, speed, heading, now=None):
+        if now is None:
+            now = time.time()
+
+        x = speed * math.sin(math.radians(heading))
+        y = speed * math.cos(math.radians(heading))
+        start = now - (now % self.width)
+        if self.buckets and self.buckets[-1][0] == start:
+            bucket = self.buckets[-1]
+            bucket[1] += x
+            bucket[2] += y
+        else:
+            bucket = [start, x, y, speed, heading]
+            self.buckets.append(bucket)
+        self.x += x
+        self.y += y
+
+        if speed >= bucket[3]:
+            bucket[3] = speed
+            bucket[4] = heading
+            while self.gusts and self.gusts[-1][1] <= speed:
+                self.gusts.pop()
+            self.gusts.append((start, speed, heading))
+
+        cutoff = now - self.window
+        while self.buckets and self.buckets[0][0] + self.width <= cutoff:
+            old = self.buckets.popleft()
+            self.x -= old[1]
+            self.y -= old[2]
+            if self.gusts and self.gusts[0][0] == old[0]:
+                self.gusts.popleft()
+
+    def direction(self):
+        if not self.buckets or (abs(self.x) < 1e-9 and abs(self.y) < 1e-9):
+            # calm, there is no direction
+            return None
+        return round(math.degrees(math.atan2(self.x, self.y)), 3) % 360
+
+    def gust(self):
+        return self.gusts[0][1] if self.gusts else None
+
+    def gustdir(self):
+        return self.gusts[0][2] if self.gusts else None
+
+
+def make_window(window, vector=False):
+    if vector:
+        return WindWindow(window)
+    if window == DAILY:
+        return DailyWindow()
+    return RollingWindow(window)
+
+
+class Statistics(object):
+    """
+    The statistics for one station.  Only the station's dispatcher thread
+    calls update() and flush(), the lock keeps the windows consistent
+    while the long poll copies them.
+    """
+
+    def __init__(self):
+        self.windows = {}
+        self.inputs = {}
+        self.outputs = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def configure(self, derived_map, address):
+        """
+        derived_map is the station's map of derived values, the entries
+        for statistics have the window they were configured with (None
+        for the default).  Windows that are still in use keep their
+        history.
+        """
+        windows = {}
+        inputs = {}
+        outputs = {}
+        for name in derived_map:
+            info = derived_map[name]
+            if (info['node'], name) not in STATISTICS:
+                continue
+            src_node, src_driver, stat, default = \
+                    STATISTICS[(info['node'], name)]
+            window = info.get('window') or parse_window(default)
+
+            key = (address(src_node), src_driver, window)
+            if key not in windows:
+                windows[key] = self.windows.get(key) or \
+                        make_window(window, src_driver is None)
+                drivers = [src_driver]
+                if src_driver is None:
+                    drivers = [WIND_SPEED, WIND_DIR]
+                for driver in drivers:
+                    inputs.setdefault((key[0], driver), []).append(windows[key])
+            outputs.setdefault(windows[key], []).append(
+                    (stat, info['address'], info['driver']))
+
+        with self.lock:
+            self.windows = windows
+            self.inputs = inputs
+            self.outputs = outputs
+            self.dirty = set()
+
+    def state(self):
+        """ The history of each window, window key -> window state """
+        with self.lock:
+            state = {}
+            for key in self.windows:
+                state[key] = self.windows[key].state()
+            return state
+
+    def restore(self, state):
+        with self.lock:
+            for key in self.windows:
+                if key in state:
+                    try:
+                        self.windows[key].restore(state[key])
+                    except Exception:
+                        pass
+
+    def update(self, address, driver, value):
+        windows = self.inputs.get((address, driver))
+        if windows is None:
+            return
+        with self.lock:
+            for window in windows:
+                window.update(driver, value)
+                self.dirty.add(window)
+
+    def flush(self, nodes):
+        if not self.dirty:
+            return
+        updates = []
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = set()
+            for window in dirty:
+                window.commit()
+                for stat, address, driver in self.outputs.get(window, ()):
+                    value = getattr(window, stat)()
+                    if value is not None:
+                        updates.append((address, driver, round(value, 3)))
+        for address, driver, value in updates:
+            if address in nodes:
+                nodes[address].setDriver(driver, value)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Pressure trend over a fixed time window.
+
+Pressure samples are kept in a fixed size, timestamped ring buffer.  The
+window is divided into capacity slots, a sample arriving within the
+same slot as the previous one replaces it, so memory use doesn't depend
+on how often the station uploads.  Samples older than the window are
+dropped from the tail as new samples arrive which keeps the trend
+calculation O(1) (amortized) per sample.
+Copyright (c) 2018 Robert Paauwe
+"""
+import time
+
+# I_TREND editor values
+FALLING = 0
+STEADY = 1
+RISING = 2
+
+
+class TrendBuffer(object):
+
+    def __init__(self, window=3 * 60 * 60, threshold=1.0, capacity=180):
+        self.capacity = capacity
+        self.times = [0.0] * capacity
+        self.values = [0.0] * capacity
+        self.head = 0
+        self.count = 0
+        self.configure(window, threshold)
+
+    def configure(self, window, threshold):
+        """ window in seconds, threshold in the units of the samples """
+        self.window = window
+        self.threshold = threshold
+        self.interval = float(window) / self.capacity
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def state(self):
+        return (self.capacity, list(self.times), list(self.values),
+                self.head, self.count)
+
+    def restore(self, state):
+        capacity, times, values, head, count = state
+        if capacity != self.capacity:
+            return False
+        self.times = list(times)
+        self.values = list(values)
+        self.head = head
+        self.count = count
+        return True
+
+    def add(self, value, now=None):
+        """ Add a sample and return the current trend. """
+        if now is None:
+            now = time.time()
+
+        if self.count and now - self.times[self.head] < self.interval:
+            # Same slot as the last sample, just keep the latest value
+            self.values[self.head] = value
+        else:
+            if self.count:
+                self.head = (self.head + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            self.times[self.head] = now
+            self.values[self.head] = value
+
+        # Drop anything that has aged out of the window, always keeping
+        # the current sample.
+        while self.count > 1 and now - self.times[self.tail()] > self.window:
+            self.count -= 1
+
+        return self.trend()
+
+    def tail(self):
+        return (self.head - self.count + 1) % self.capacity
+
+    def trend(self):
+        if self.count == 0:
+            return STEADY
+        change = self.values[self.head] - self.values[self.tail()]
+        if change > self.threshold:
+            return RISING
+        if change < -self.threshold:
+            return FALLING
+        return STEADY
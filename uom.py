@@ -23,3 +23,107 @@ UOM = {
         'I_KM': 83,
         'I_MILE': 116,
         }
+
+
+# Unit conversion
+#
+# Converters are looked up by (quantity, from unit, to unit) and bound to
+# each driver when the nodes are created so setDriver doesn't have to
+# check the units on every update.
+
+# Linear units, the factor converts the unit to the first unit listed.
+FACTORS = {
+        'pressure': {'mb': 1.0, 'hPa': 1.0, 'inHg': 1 / 0.02952998751},
+        'speed': {'m/s': 1.0, 'kph': 1 / 3.6, 'mph': 0.44704,
+            'knots': 0.514444},
+        'rain': {'mm': 1.0, 'in': 25.4},
+        'rainrate': {'mm/h': 1.0, 'in/h': 25.4},
+        'distance': {'km': 1.0, 'mile': 1.609344},
+        }
+
+# Decimal places to keep after converting
+PRECISION = {
+        'temperature': 2,
+        'pressure': 3,
+        'speed': 2,
+        'rain': 2,
+        'rainrate': 2,
+        'distance': 1,
+        }
+
+# Editor ID -> (quantity, unit)
+EDITOR_UNITS = {
+        'I_TEMP_C': ('temperature', 'C'),
+        'I_TEMP_F': ('temperature', 'F'),
+        'I_MB': ('pressure', 'mb'),
+        'I_INHG': ('pressure', 'inHg'),
+        'I_KPH': ('speed', 'kph'),
+        'I_MPH': ('speed', 'mph'),
+        'I_MMHR': ('rainrate', 'mm/h'),
+        'I_INHR': ('rainrate', 'in/h'),
+        'I_MM': ('rain', 'mm'),
+        'I_INCHES': ('rain', 'in'),
+        'I_KM': ('distance', 'km'),
+        'I_MILE': ('distance', 'mile'),
+        }
+
+# Units of the incoming data for the IncomingUnits setting
+INCOMING = {
+        'metric': {'temperature': 'C', 'pressure': 'mb', 'speed': 'kph',
+            'rain': 'mm', 'rainrate': 'mm/h', 'distance': 'km'},
+        'us': {'temperature': 'F', 'pressure': 'inHg', 'speed': 'mph',
+            'rain': 'in', 'rainrate': 'in/h', 'distance': 'mile'},
+        'uk': {'temperature': 'C', 'pressure': 'mb', 'speed': 'mph',
+            'rain': 'mm', 'rainrate': 'mm/h', 'distance': 'mile'},
+        }
+
+CONVERSIONS = {}
+
+
+def register(quantity, from_unit, to_unit, function):
+    CONVERSIONS[(quantity, from_unit, to_unit)] = function
+
+
+def linear(factor, places):
+    return lambda value: round(value * factor, places)
+
+
+register('temperature', 'F', 'C', lambda value: round((value - 32) / 1.8, 2))
+register('temperature', 'C', 'F', lambda value: round((value * 1.8) + 32, 2))
+
+for quantity in FACTORS:
+    for from_unit in FACTORS[quantity]:
+        for to_unit in FACTORS[quantity]:
+            if from_unit != to_unit:
+                register(quantity, from_unit, to_unit,
+                        linear(FACTORS[quantity][from_unit] /
+                            FACTORS[quantity][to_unit], PRECISION[quantity]))
+
+
+def converter(quantity, from_unit, to_unit):
+    """ Function converting the value, None if no conversion is needed. """
+    if from_unit == to_unit:
+        return None
+    try:
+        return CONVERSIONS[(quantity, from_unit, to_unit)]
+    except KeyError:
+        raise ValueError('No conversion from %s to %s' % (from_unit, to_unit))
+
+
+def incoming(units, speed=None):
+    """ Units of the incoming data, speed overrides the wind speed unit. """
+    units = dict(INCOMING.get(units, INCOMING['metric']))
+    if speed is not None:
+        units['speed'] = speed
+    return units
+
+
+def driver_converter(editor, units_in):
+    """
+    Function converting a driver's value from the incoming units to the
+    units of its editor, None if no conversion is needed.
+    """
+    if editor not in EDITOR_UNITS:
+        return None
+    quantity, unit = EDITOR_UNITS[editor]
+    return converter(quantity, units_in[quantity], unit)
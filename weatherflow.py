@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+WeatherFlow Smart Weather hub local UDP broadcasts.
+
+The hub broadcasts JSON messages on UDP port 50222.  Observation values
+are sent as lists, the field names below are used as the mapping keys
+in the node server configuration (temperature-main = air_temperature).
+
+All values are metric, wind speeds are in m/s.  They're converted to
+the station's incoming units (IncomingUnits and IncomingWindUnits) when
+the plan is built so the nodes convert them like any other source.
+Copyright (c) 2018 Robert Paauwe
+"""
+import json
+import socket
+import threading
+import uom
+
+PORT = 50222
+
+# Field names, in order, for each observation message type
+FIELDS = {
+        'obs_st': ('timestamp', 'wind_lull', 'wind_avg', 'wind_gust',
+            'wind_direction', 'wind_sample_interval', 'station_pressure',
+            'air_temperature', 'relative_humidity', 'illuminance', 'uv',
+            'solar_radiation', 'rain_accumulated', 'precipitation_type',
+            'lightning_strike_avg_distance', 'lightning_strike_count',
+            'battery', 'report_interval'),
+        'obs_air': ('timestamp', 'station_pressure', 'air_temperature',
+            'relative_humidity', 'lightning_strike_count',
+            'lightning_strike_avg_distance', 'battery', 'report_interval'),
+        'obs_sky': ('timestamp', 'illuminance', 'uv', 'rain_accumulated',
+            'wind_lull', 'wind_avg', 'wind_gust', 'wind_direction',
+            'battery', 'report_interval', 'solar_radiation',
+            'local_day_rain_accumulation', 'precipitation_type',
+            'wind_sample_interval'),
+        'rapid_wind': ('timestamp', 'wind_speed', 'wind_direction'),
+        'evt_strike': ('timestamp', 'strike_distance', 'strike_energy'),
+        }
+
+# Key holding the values for each message type.  obs_* hold a list of
+# observations, the others a single observation.
+VALUES = {
+        'obs_st': 'obs',
+        'obs_air': 'obs',
+        'obs_sky': 'obs',
+        'rapid_wind': 'ob',
+        'evt_strike': 'evt',
+        }
+
+# Quantity and unit of the fields that have units
+UNITS = {
+        'wind_lull': ('speed', 'm/s'),
+        'wind_avg': ('speed', 'm/s'),
+        'wind_gust': ('speed', 'm/s'),
+        'wind_speed': ('speed', 'm/s'),
+        'station_pressure': ('pressure', 'mb'),
+        'air_temperature': ('temperature', 'C'),
+        'rain_accumulated': ('rain', 'mm'),
+        'local_day_rain_accumulation': ('rain', 'mm'),
+        'lightning_strike_avg_distance': ('distance', 'km'),
+        'strike_distance': ('distance', 'km'),
+        }
+
+# Controller battery/RSSI drivers by device serial number prefix. The
+# Tempest replaces both the Air and the Sky.
+DEVICE_DRIVERS = {
+        'AR': (('GV0', 'GV2'),),
+        'SK': (('GV1', 'GV3'),),
+        'ST': (('GV0', 'GV2'), ('GV1', 'GV3')),
+        }
+
+
+def field_converter(name, incoming, convert=float):
+    """
+    Function converting a field to the incoming units, convert for the
+    fields without units.
+    """
+    if name not in UNITS:
+        return convert
+    quantity, unit = UNITS[name]
+    to_incoming = uom.converter(quantity, unit, incoming[quantity])
+    return float if to_incoming is None else to_incoming
+
+
+def compile_plan(plan, incoming):
+    """
+    Build a positional plan for each message type from the keyed plan
+    so a message only touches the mapped fields.  Returns a dictionary of
+    message type -> (tuple of (index, node address, driver, converter),
+    tuple of expressions with their inputs as indexes).  Expressions are
+    only used for the message types that have all of their inputs.
+    """
+    wfplan = {}
+    for mtype in FIELDS:
+        names = FIELDS[mtype]
+        fields = []
+        for i, name in enumerate(names):
+            for address, driver, convert in plan.keys.get(name, ()):
+                fields.append((i, address, driver,
+                    field_converter(name, incoming, convert)))
+
+        exprs = []
+        for inputs, converters, function, address, driver in plan.key_exprs:
+            if not all(name in names for name in inputs):
+                continue
+            exprs.append((tuple(names.index(name) for name in inputs),
+                tuple(field_converter(name, incoming) for name in inputs),
+                function, address, driver))
+        wfplan[mtype] = (tuple(fields), tuple(exprs))
+    return wfplan
+
+
+class Listener(threading.Thread):
+    """
+    Receive the hub broadcasts and queue them for the station the hub is
+    configured for.  route(hub serial number) returns the station's
+    ingest queue or None if the hub isn't configured.
+
+    The datagram is received into a preallocated buffer, the only work
+    done on this thread is decoding it and queuing it.  Queuing never
+    waits, whatever the QueueOverflow policy, the next broadcast would be
+    lost while it did.
+    """
+
+    def __init__(self, route, logger, port=PORT):
+        threading.Thread.__init__(self, name='weatherflow')
+        self.daemon = True
+        self.route = route
+        self.logger = logger
+        self.port = port
+        self.received = 0
+        self.ignored = 0
+        self.stopped = threading.Event()
+        self.buffer = bytearray(4096)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.settimeout(1)
+        self.sock.bind(('', self.port))
+
+    def run(self):
+        self.logger.info('Listening for WeatherFlow data on UDP port %d' %
+                self.port)
+        view = memoryview(self.buffer)
+        while not self.stopped.is_set():
+            try:
+                count = self.sock.recv_into(self.buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                # socket closed by stop()
+                break
+
+            try:
+                message = json.loads(view[:count].tobytes())
+                hub = message.get('hub_sn', message.get('serial_number'))
+            except (ValueError, AttributeError):
+                self.ignored += 1
+                continue
+
+            queue = self.route(hub)
+            if queue is None:
+                self.ignored += 1
+                continue
+
+            self.received += 1
+            queue.put(('weatherflow', message), block=False)
+
+        self.logger.info('WeatherFlow listener stopped.')
+
+    def stop(self):
+        self.stopped.set()
+        self.sock.close()
+
+
+# Send sample hub broadcasts to test the listener without a hub:
+#
+#   python3 weatherflow.py [host] [port]
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    host = sys.argv[1] if len(sys.argv) > 1 else '<broadcast>'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else PORT
+    hub = 'HB-00000001'
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+    def send(message):
+        message['hub_sn'] = hub
+        sock.sendto(json.dumps(message).encode(), (host, port))
+
+    now = int(time.time())
+    send({'serial_number': 'ST-00000512', 'type': 'obs_st', 'obs': [[now,
+        0.18, 0.22, 0.27, 144, 6, 1017.57, 22.37, 50.26, 328, 0.03, 3, 0.0,
+        0, 0, 0, 2.410, 1]], 'firmware_revision': 129})
+    send({'serial_number': 'ST-00000512', 'type': 'device_status',
+        'timestamp': now, 'uptime': 2189, 'voltage': 2.41,
+        'firmware_revision': 129, 'rssi': -56, 'hub_rssi': -58,
+        'sensor_status': 0, 'debug': 0})
+    for i in range(10):
+        send({'serial_number': 'ST-00000512', 'type': 'rapid_wind',
+            'ob': [int(time.time()), 2.3 + i / 10.0, 128 + i]})
+        time.sleep(0.5)
+    send({'serial_number': 'ST-00000512', 'type': 'evt_strike',
+        'evt': [int(time.time()), 27, 3848]})
@@ -5,8 +5,9 @@ Copyright (c) 2018 Robert Paauwe
 """
 import polyinterface
 import sys
+import os
+import re
 import time
-import datetime
 #import urllib3
 import urllib
 import json
@@ -16,11 +17,49 @@ import threading
 import struct
 import write_profile
 import uom
+import ingest
+import mapping
+import publish
+import weatherflow
+import realtime
+import derived
+import trend
+import stats
+import rain
+import history
+import compact
+import snapshot
+import outbox
+import freshness
 #from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 import http.server
+import socketserver
+import concurrent.futures
 
 LOGGER = polyinterface.LOGGER
 
+# Additional station ids are used in node addresses, keep them short
+STATION_ID = re.compile('^[a-z0-9]{1,8}$')
+
+# Station parameters that change the station's mapping or nodes.  Other
+# parameters are applied by set_configuration alone.
+STATION_PARAMS = ('Units', 'IncomingUnits', 'IncomingWindUnits', 'Elevation')
+
+# Parameters that change the nodes of every station
+NODE_PARAMS = ('TrendWindow', 'TrendThreshold')
+
+# Seconds to wait for the configuration callbacks to settle
+CONFIG_SETTLE = 2.0
+
+def config_diff(old, new):
+    """ Names of the parameters that were added, removed or changed """
+    changed = set()
+    for key in set(old) | set(new):
+        if key not in old or key not in new or old[key] != new[key]:
+            changed.add(key)
+    return changed
+
+
 class Controller(polyinterface.Controller):
     def __init__(self, polyglot):
         super(Controller, self).__init__(polyglot)
@@ -28,38 +67,104 @@ class Controller(polyinterface.Controller):
         self.address = 'weather'
         self.primary = self.address
         self.port = 8080
+        self.workers = 4
+        self.max_requests = 16
+        self.queue_size = 100
+        self.queue_overflow = ingest.DROP_OLDEST
+        self.server = None
+        self.stations = {}
+        self.wf_port = weatherflow.PORT
+        self.wf_hubs = {}
+        self.wf_listener = None
+        self.rt_interval = 2
+        self.rt_files = {}
+        self.rt_watcher = None
+        self.trend_window = 180
+        self.trend_threshold = 1.0
+        self.max_silence = 600
+        self.publish_filter = publish.PublishFilter()
+        self.coalescer = publish.Coalescer(LOGGER)
+        self.scheduler = publish.PublishScheduler(LOGGER, WeatherNode.deliver)
+        self.history = history.HistoryStore(LOGGER)
+        self.compactor = compact.Compactor(self.history, LOGGER)
+        self.history.compactor = self.compactor
+        self.outbox = outbox.Outbox(self.poly_connected, self.send_held, LOGGER)
+        self.freshness = freshness.FreshnessTracker(LOGGER)
         self_server_running = False
-        self.units = ""
-        self.in_units = ""
-        self.temperature_list = {}
-        self.humidity_list = {}
-        self.pressure_list = {}
-        self.wind_list = {}
-        self.rain_list = {}
-        self.light_list = {}
-        self.lightning_list = {}
-        self.map = {}
         self.myConfig = {}
+        self.pending_config = None
+        self.config_timer = None
+        self.config_lock = threading.Lock()
+        self.reconfig_lock = threading.Lock()
 
         self.poly.onConfig(self.process_config)
 
     def process_config(self, config):
-        # this seems to get called twice for every change, why?
-        # What does config represent?
-        if 'customParams' in config and self.myConfig:
-            if config['customParams'] != self.myConfig:
-                LOGGER.debug("Found difference with saved configuration.")
-                self.removeNoticesAll()
-                self.set_configuration(config)
-                self.map_nodes(config)
-                self.discover()
-                try:
-                    if config['customParams']['Port'] != self.myConfig['Port']:
-                        self.addNotice("Restart node server for Port change to take effect")
-                except:
-                    self.addNotice("Must have a Port parameter set.")
+        # Polyglot calls this more than once for every change, wait for
+        # the calls to settle and then reconfigure once.
+        if 'customParams' not in config or not self.myConfig:
+            return
+        with self.config_lock:
+            if config['customParams'] == self.myConfig and \
+                    self.config_timer is None:
+                return
+            self.pending_config = config
+            if self.config_timer is not None:
+                self.config_timer.cancel()
+            self.config_timer = threading.Timer(CONFIG_SETTLE,
+                    self.apply_config)
+            self.config_timer.daemon = True
+            self.config_timer.start()
+
+    def apply_config(self):
+        with self.config_lock:
+            config = self.pending_config
+            self.pending_config = None
+            self.config_timer = None
+        if config is not None:
+            with self.reconfig_lock:
+                self.reconfigure(config)
+
+    def reconfigure(self, config):
+        """
+        Apply a changed configuration.  Only the stations whose mapping
+        or nodes depend on a changed parameter are mapped again and only
+        nodes whose drivers changed are updated, the rest keep running
+        with their current values.
+        """
+        params = config['customParams']
+        changed = config_diff(self.myConfig, params)
+        if not changed:
+            return
+        LOGGER.debug("Found difference with saved configuration: %s" %
+                ', '.join(sorted(changed)))
+        self.removeNoticesAll()
 
-                self.myConfig = config['customParams']
+        before = set(self.stations)
+        self.set_configuration(config)
+        sids = set(self.stations) - before
+        for key in changed:
+            sid, name = key.split('.', 1) if '.' in key else ('', key)
+            if name in NODE_PARAMS:
+                sids.update(self.stations)
+            elif ('-' in name or name in STATION_PARAMS) and \
+                    sid in self.stations:
+                sids.add(sid)
+
+        if sids:
+            self.map_nodes(config, sids)
+            for sid in sids:
+                self.discover_station(self.stations[sid])
+        self.weatherflow_listener()
+        self.realtime_watcher()
+        self.history_store()
+        try:
+            if params['Port'] != self.myConfig['Port']:
+                self.addNotice("Restart node server for Port change to take effect")
+        except:
+            self.addNotice("Must have a Port parameter set.")
+
+        self.myConfig = params
 
     def start(self):
         LOGGER.info('Starting WeatherPoly Node Server')
@@ -67,21 +172,62 @@ class Controller(polyinterface.Controller):
         self.check_params()
         LOGGER.info('Calling discover')
         self.discover()
+        self.restore_snapshot()
+        self.outbox.start()
 
         LOGGER.info('starting web server thread')
         self.data_thread = threading.Thread(target = self.web_server)
         self.data_thread.daemon = True
         self.data_thread.start()
 
+        self.weatherflow_listener()
+        self.realtime_watcher()
+        self.history_store()
+
         #for node in self.nodes:
         #       LOGGER.info (self.nodes[node].name + ' is at index ' + node)
         LOGGER.info('WeatherPoly Node Server Started.')
 
     def shortPoll(self):
-        pass
+        # FlushWindow = shortPoll, publish the coalesced updates now
+        if self.coalescer.window is None:
+            self.coalescer.flush()
 
     def longPoll(self):
-        pass
+        for sid in list(self.stations):
+            queue = self.stations[sid].ingest
+            LOGGER.info('Ingest queue %s depth %d (high water %d of %d, %d dropped)' %
+                    (sid or 'default', queue.depth, queue.high_water,
+                     queue.size, queue.dropped))
+        published, suppressed = self.publish_filter.counts()
+        LOGGER.info('Published %d driver updates, suppressed %d unchanged, %d coalesced' %
+                (published, suppressed, self.coalescer.coalesced))
+        if self.scheduler.deferred:
+            LOGGER.info('Deferred %d driver updates, %d waiting' %
+                    (self.scheduler.deferred, len(self.scheduler.pending)))
+        if self.history.days:
+            LOGGER.info('History recorded %d values, %d dropped' %
+                    (self.history.written, self.history.dropped))
+        if self.outbox.pending or self.outbox.held:
+            LOGGER.info('Outbox holding %d driver updates (%d held, %d sent)' %
+                    (len(self.outbox.pending), self.outbox.held,
+                     self.outbox.replayed))
+        self.check_freshness()
+        self.save_rain()
+        self.save_snapshot()
+
+    # ST shows whether every station is sending data.  When a station
+    # comes back its nodes are reported again, a node at a time, in case
+    # the ISY missed anything while it was gone.
+    def check_freshness(self):
+        for sid in self.freshness.check(self.stations, self.nodes):
+            if self.outbox.holding():
+                continue
+            for kind in write_profile.NODE_DRVS:
+                node = self.nodes.get(self.stations[sid].address(kind))
+                if node is not None:
+                    node.reportDrivers()
+        self.setDriver('ST', 1 if self.freshness.online() else 0)
 
     def query(self):
         for node in self.nodes:
@@ -104,143 +250,124 @@ class Controller(polyinterface.Controller):
         """
 
         LOGGER.info("Creating nodes.")
-        t_drvs = []
-        h_drvs = []
-        p_drvs = []
-        w_drvs = []
-        r_drvs = []
-        l_drvs = []
-        s_drvs = []
-
-        for key in self.map:
-            info = self.map[key]
-            if info['node'] == 'temperature':
-                t_drvs.append( {
-                    'driver': info['driver'],
-                    'value': 0,
-                    'uom': uom.UOM[info['units']]
-                    })
-            elif info['node'] == 'humidity':
-                h_drvs.append( {
-                    'driver': info['driver'],
-                    'value': 0,
-                    'uom': uom.UOM[info['units']]
-                    })
-            elif info['node'] == 'pressure':
-                p_drvs.append( {
-                    'driver': info['driver'],
-                    'value': 0,
-                    'uom': uom.UOM[info['units']]
-                    })
-            elif info['node'] == 'wind':
-                w_drvs.append( {
-                    'driver': info['driver'],
-                    'value': 0,
-                    'uom': uom.UOM[info['units']]
-                    })
-            elif info['node'] == 'rain':
-                r_drvs.append( {
-                    'driver': info['driver'],
-                    'value': 0,
-                    'uom': uom.UOM[info['units']]
-                    })
-            elif info['node'] == 'light':
-                l_drvs.append( {
-                    'driver': info['driver'],
-                    'value': 0,
-                    'uom': uom.UOM[info['units']]
-                    })
-            elif info['node'] == 'lightning':
-                s_drvs.append( {
+        # New nodes start at 0, make sure the next update is published
+        self.publish_filter.reset()
+
+        for sid in list(self.stations):
+            self.discover_station(self.stations[sid], True)
+
+    def discover_station(self, station, full=False):
+        """
+        Add, update or remove the station's nodes to match its mapping.
+        Existing nodes keep their values, they're only added again when
+        their drivers changed.  A full discover also removes nodes left
+        over from a previous run.
+        """
+        drvs = {}
+        converters = {}
+        for kind in write_profile.NODE_DRVS:
+            drvs[kind] = []
+            converters[kind] = {}
+
+        for info in list(station.map.values()) + \
+                list(station.derived_map.values()):
+            if info['units'] is None:
+                continue
+            if info['node'] in drvs:
+                drvs[info['node']].append( {
                     'driver': info['driver'],
                     'value': 0,
                     'uom': uom.UOM[info['units']]
                     })
+                # Pick the unit conversion now rather than on every update
+                converters[info['node']][info['driver']] = \
+                        uom.driver_converter(info['units'], station.incoming)
             else:
                 LOGGER.debug(' - Skipping, no such node.')
 
-        if len(t_drvs) > 0:
-            LOGGER.info("Creating Temperature node")
-            node = TemperatureNode(self, self.address, 'temperature',
-                    'Temperatures')
-            node.SetUnits(self.units, self.in_units)
-            node.drivers = t_drvs;
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned temperature node')
-            self.delNode('temperature')
-
-        if len(h_drvs) > 0:
-            LOGGER.info("Creating Humidity node")
-            node = HumidityNode(self, self.address, 'humidity', 'Humidity')
-            node.drivers = h_drvs
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned humidity node')
-            self.delNode('humidity')
-
-        if len(p_drvs) > 0:
-            LOGGER.info("Creating Pressure node")
-            node = PressureNode(self, self.address, 'pressure', 'Barometric Pressure')
-            node.SetUnits(self.units, self.in_units)
-            node.drivers = p_drvs
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned pressure node')
-            self.delNode('pressure')
-
-        if len(w_drvs) > 0:
-            LOGGER.info("Creating Wind node")
-            node = WindNode(self, self.address, 'wind', 'Wind')
-            node.SetUnits(self.units, self.in_units)
-            node.drivers = w_drvs
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned wind node')
-            self.delNode('wind')
-
-        if len(r_drvs) > 0:
-            LOGGER.info("Creating Precipitation node")
-            node = PrecipitationNode(self, self.address, 'rain', 'Precipitation')
-            node.SetUnits(self.units, self.in_units)
-            node.drivers = r_drvs
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned rain node')
-            self.delNode('rain')
-
-        if len(l_drvs) > 0:
-            LOGGER.info("Creating Light node")
-            node = LightNode(self, self.address, 'light', 'Illumination')
-            node.drivers = l_drvs
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned light node')
-            self.delNode('light')
-
-        if len(s_drvs) > 0:
-            LOGGER.info("Creating Lightning node")
-            node = LightningNode(self, self.address, 'lightning', 'Lightning')
-            node.SetUnits(self.units, self.in_units)
-            node.drivers = s_drvs
-            self.addNode(node)
-        else:
-            LOGGER.info('Deleting orphaned lightning node')
-            self.delNode('lightning')
-
+        for kind, node_class, name in NODE_TYPES:
+            address = station.address(kind)
+            if len(drvs[kind]) > 0:
+                node = self.nodes.get(address)
+                if node is None:
+                    LOGGER.info("Creating %s node %s" % (name, address))
+                    node = node_class(self, self.address, address,
+                            station.node_name(name))
+                    if station.id != '':
+                        node.id = write_profile.nodedef_id(station.id, kind)
+                else:
+                    # Keep the values of drivers that are still there
+                    # with the same units.
+                    current = {}
+                    for d in node.drivers:
+                        current[(d['driver'], d['uom'])] = d['value']
+                    for d in drvs[kind]:
+                        d['value'] = current.get((d['driver'], d['uom']), 0)
+
+                node.SetUnits(station.units, station.incoming)
+                node.SetConverters(converters[kind])
+                if kind == 'pressure':
+                    node.SetTrend(self.trend_window * 60, self.trend_threshold,
+                            'trend' in station.derived_map,
+                            'GV0' if 'sealevel' in station.lists['pressure'] else 'ST')
+
+                if address in self.nodes and [(d['driver'], d['uom'])
+                        for d in node.drivers] == [(d['driver'], d['uom'])
+                        for d in drvs[kind]]:
+                    continue
+                if address in self.nodes:
+                    LOGGER.info("Updating %s node %s" % (name, address))
+                node.drivers = drvs[kind]
+                self.publish_filter.forget(address)
+                self.addNode(node)
+            elif full or address in self.nodes:
+                LOGGER.info('Deleting orphaned %s node' % address)
+                self.delNode(address)
+                self.nodes.pop(address, None)
+
+    def remove_station(self, sid):
+        station = self.stations.pop(sid)
+        station.stop()
+        LOGGER.info('Removing station %s' % sid)
+        for kind in write_profile.NODE_DRVS:
+            self.delNode(station.address(kind))
 
     def delete(self):
-        self.stopping = True
-        self.server.Stop = True
+        self.shutdown()
         LOGGER.info('Removing WeatherPoly node server.')
 
     def stop(self):
-        self.stopping = True
-        self.server.Stop = True
-        self.server.socket.close()
+        self.shutdown()
         LOGGER.debug('Stopping WeatherPoly node server.')
 
+    # Stop the threads and save the state that has to survive a restart
+    def shutdown(self):
+        self.stopping = True
+        with self.config_lock:
+            if self.config_timer is not None:
+                self.config_timer.cancel()
+                self.config_timer = None
+        if self.server is not None:
+            self.server.stop_server()
+        if self.wf_listener is not None:
+            self.wf_listener.stop()
+        if self.rt_watcher is not None:
+            self.rt_watcher.stop()
+        for sid in self.stations:
+            self.stations[sid].stop()
+        self.coalescer.stop()
+        self.scheduler.stop()
+        self.compactor.stop()
+        self.history.stop()
+        self.outbox.stop()
+        self.save_rain()
+        self.save_snapshot()
+
     def check_params(self):
+        # Remove all existing notices, before the configuration is checked
+        # so its errors are reported.
+        LOGGER.info("remove all notices")
+        self.removeNoticesAll()
 
         self.set_configuration(self.polyConfig)
 
@@ -248,22 +375,45 @@ class Controller(polyinterface.Controller):
         LOGGER.info("Adding configuation")
         self.addCustomParam({
                     'Port': self.port,
-                    'Units': self.units,
-                    'IncomingUnits': self.in_units,
+                    'Units': self.stations[''].units,
+                    'IncomingUnits': self.stations[''].in_units,
+                    'IncomingWindUnits': '',
+                    'Stations': '',
+                    'Workers': self.workers,
+                    'MaxRequests': self.max_requests,
+                    'QueueSize': self.queue_size,
+                    'QueueOverflow': self.queue_overflow,
+                    'Deadband': '',
+                    'MaxSilence': self.max_silence,
+                    'StaleTimeout': self.freshness.timeout,
+                    'PublishPolicy': '',
+                    'MaxPublishRate': self.scheduler.rate,
+                    'FlushWindow': 0,
+                    'ReplayRate': self.outbox.rate,
+                    'OutboxFile': '',
+                    'WeatherFlow': '',
+                    'WeatherFlowPort': self.wf_port,
+                    'RealtimeFile': '',
+                    'RealtimeInterval': self.rt_interval,
+                    'Elevation': self.stations[''].elevation,
+                    'TrendWindow': self.trend_window,
+                    'TrendThreshold': self.trend_threshold,
+                    'HistoryDays': self.history.days,
+                    'HistoryMinuteDays': self.compactor.retention['minute'],
+                    'HistoryHourDays': self.compactor.retention['hour'],
+                    'HistoryDayDays': self.compactor.retention['day'],
                     })
 
         self.map_nodes(self.polyConfig)
         self.myConfig = self.polyConfig['customParams']
 
-        # Remove all existing notices
-        LOGGER.info("remove all notices")
-        self.removeNoticesAll()
-
-        # Add a notice?
-
     def set_configuration(self, config):
         default_port = 8080
         default_elevation = 0
+        default_workers = 4
+        default_max_requests = 16
+        default_queue_size = 100
+        default_max_silence = 600
 
         LOGGER.info("Check for existing configuration value")
 
@@ -272,17 +422,205 @@ class Controller(polyinterface.Controller):
         else:
             self.port = default_port
 
-        if 'Units' in config['customParams']:
-            self.units = config['customParams']['Units']
-        else:
-            self.units = 'metric'
+        # Size of the web server worker pool and the maximum number of
+        # requests that may be queued or running at once.
+        try:
+            self.workers = max(1, int(config['customParams']['Workers']))
+        except:
+            self.workers = default_workers
 
-        if 'IncomingUnits' in config['customParams']:
-            self.in_units = config['customParams']['IncomingUnits']
+        try:
+            self.max_requests = max(self.workers,
+                    int(config['customParams']['MaxRequests']))
+        except:
+            self.max_requests = max(self.workers, default_max_requests)
+
+        # Size of the ingest queue and what to do when it fills up.
+        try:
+            self.queue_size = max(1, int(config['customParams']['QueueSize']))
+        except:
+            self.queue_size = default_queue_size
+
+        if 'QueueOverflow' in config['customParams'] and \
+                config['customParams']['QueueOverflow'] in ingest.OVERFLOW:
+            self.queue_overflow = config['customParams']['QueueOverflow']
         else:
-            self.in_units = 'metric'
+            self.queue_overflow = ingest.DROP_OLDEST
+
+        # Per driver deadbands and the maximum time a driver can go
+        # without being published.
+        try:
+            self.max_silence = int(config['customParams']['MaxSilence'])
+        except:
+            self.max_silence = default_max_silence
+
+        deadbands = {}
+        if 'Deadband' in config['customParams']:
+            try:
+                deadbands = publish.parse_deadbands(config['customParams']['Deadband'])
+            except ValueError as e:
+                LOGGER.error('Deadband: {}'.format(e))
+                self.addNotice('Deadband: {}'.format(e))
+        self.publish_filter.configure(deadbands, self.max_silence)
+
+        # Per node/driver publish rate limits and priorities, and the
+        # maximum number of updates published per second.
+        policies = {}
+        if 'PublishPolicy' in config['customParams']:
+            try:
+                policies = publish.parse_policies(config['customParams']['PublishPolicy'])
+            except ValueError as e:
+                LOGGER.error('PublishPolicy: {}'.format(e))
+                self.addNotice('PublishPolicy: {}'.format(e))
+        try:
+            rate = int(config['customParams']['MaxPublishRate'])
+        except:
+            rate = 0
+        self.scheduler.configure(policies, rate)
+
+        # Seconds without data before a station is offline and its values
+        # are stale, 0 to not check.
+        try:
+            self.freshness.configure(max(0, int(config['customParams']['StaleTimeout'])))
+        except:
+            self.freshness.configure(900)
+
+        # Coalesce driver updates over a flush window (milliseconds) or
+        # until the next shortPoll. 0 publishes every update immediately.
+        window = 0
+        if 'FlushWindow' in config['customParams']:
+            flush = str(config['customParams']['FlushWindow']).strip()
+            if flush.lower() == 'shortpoll':
+                window = None
+            else:
+                try:
+                    window = max(0, int(flush)) / 1000.0
+                except ValueError:
+                    LOGGER.error('Invalid FlushWindow %s' % flush)
+        self.coalescer.configure(window)
+
+        # Driver updates are held while Polyglot is unreachable and sent
+        # at ReplayRate updates per second when it's back. OutboxFile
+        # keeps them over a restart.
+        try:
+            rate = int(config['customParams']['ReplayRate'])
+        except:
+            rate = 20
+        path = None
+        if 'OutboxFile' in config['customParams']:
+            path = str(config['customParams']['OutboxFile']).strip() or None
+        self.outbox.configure(rate, path)
+
+        # Pressure trend window (minutes) and the change (mb) needed
+        # for the pressure to be rising/falling.
+        try:
+            self.trend_window = max(1, int(config['customParams']['TrendWindow']))
+        except:
+            self.trend_window = 180
 
-    def map_nodes(self, config):
+        try:
+            self.trend_threshold = float(config['customParams']['TrendThreshold'])
+        except:
+            self.trend_threshold = 1.0
+
+        # Days of history to keep, 0 to not record history
+        try:
+            self.history.configure(max(0, int(config['customParams']['HistoryDays'])))
+        except:
+            self.history.configure(0)
+
+        # Days to keep the 1 minute, 1 hour and 1 day history summaries
+        retention = {}
+        for tier, param, default in (('minute', 'HistoryMinuteDays', 30),
+                ('hour', 'HistoryHourDays', 365),
+                ('day', 'HistoryDayDays', 3650)):
+            try:
+                retention[tier] = max(0, int(config['customParams'][param]))
+            except:
+                retention[tier] = default
+        self.compactor.configure(retention)
+
+        # The default station plus any additional stations. Each station
+        # has its own ingest queue and dispatcher.
+        sids = ['']
+        if 'Stations' in config['customParams']:
+            for sid in str(config['customParams']['Stations']).split(','):
+                sid = sid.strip().lower()
+                if sid == '' or sid in sids:
+                    continue
+                if not STATION_ID.match(sid):
+                    LOGGER.error('Invalid station id %s' % sid)
+                    self.addNotice('Station id %s must be 1 to 8 lower case letters or digits' % sid)
+                    continue
+                sids.append(sid)
+
+        for sid in list(self.stations):
+            if sid not in sids:
+                self.remove_station(sid)
+
+        hubs = {}
+        files = {}
+        for sid in sids:
+            if sid not in self.stations:
+                LOGGER.info('Adding station %s' % (sid or 'default'))
+                station = Station(sid)
+                if sid in self.get_saved_rain():
+                    station.rain.restore(self.get_saved_rain()[sid])
+                station.start(self, self.queue_size, self.queue_overflow,
+                        weather_data_handler.timeout)
+                self.stations[sid] = station
+            station = self.stations[sid]
+
+            units = station.param(config['customParams'], 'Units')
+            station.units = units if units is not None else 'metric'
+
+            units = station.param(config['customParams'], 'IncomingUnits')
+            station.in_units = units if units is not None else 'metric'
+
+            # Wind speed units when they differ from IncomingUnits
+            speed = station.param(config['customParams'], 'IncomingWindUnits')
+            if speed is not None and str(speed).strip() != '':
+                speed = str(speed).strip()
+                if speed not in uom.FACTORS['speed']:
+                    LOGGER.error('Invalid wind speed units %s' % speed)
+                    self.addNotice('IncomingWindUnits must be one of %s' %
+                            ', '.join(sorted(uom.FACTORS['speed'])))
+                    speed = None
+            else:
+                speed = None
+            station.incoming = uom.incoming(station.in_units, speed)
+
+            # Station elevation in meters, used for sea level pressure
+            try:
+                station.elevation = float(station.param(config['customParams'], 'Elevation'))
+            except:
+                station.elevation = default_elevation
+
+            # WeatherFlow hub serial number (or 'any') that feeds this
+            # station.
+            hub = station.param(config['customParams'], 'WeatherFlow')
+            if hub is not None and str(hub).strip() != '':
+                hubs[str(hub).strip()] = station
+
+            # Local realtime file written by the weather software
+            path = station.param(config['customParams'], 'RealtimeFile')
+            if path is not None and str(path).strip() != '':
+                files[str(path).strip()] = station.ingest
+
+        self.wf_hubs = hubs
+        self.rt_files = files
+        try:
+            self.rt_interval = max(0.5, float(config['customParams']['RealtimeInterval']))
+        except:
+            self.rt_interval = 2
+        if self.rt_watcher is not None:
+            self.rt_watcher.configure(self.rt_files, self.rt_interval)
+        try:
+            self.wf_port = int(config['customParams']['WeatherFlowPort'])
+        except:
+            self.wf_port = weatherflow.PORT
+
+    def map_nodes(self, config, sids=None):
         # Build up our data mapping tables. The customParams keys will
         # look like temperature-main and the value will match something
         # from the weather software (field #, key, etc.)
@@ -291,106 +629,237 @@ class Controller(polyinterface.Controller):
         # recieved to a node and driver.  So ideally, we have a dictionary
         # with the weather software "key" as the dictionary key and the
         # dictionary value be another dictionary with node name and driver.
+        #
+        # sids limits the mapping to those stations, the others keep the
+        # mapping they have.
         LOGGER.info("Trying to create a mapping")
+        if sids is None:
+            sids = set(self.stations)
 
-        self.map.clear()
-        self.temperature_list.clear()
-        self.humidity_list.clear()
-        self.pressure_list.clear()
-        self.wind_list.clear()
-        self.rain_list.clear()
-        self.light_list.clear()
-        self.lightning_list.clear()
+        for sid in sids:
+            self.stations[sid].clear()
 
+        # Keys for additional stations are prefixed with the station id,
+        # I.E. barn.temperature-main
         for key in config['customParams']:
             if not '-' in key:
                 continue
 
-            vmap = key.split('-')
-            vval = config['customParams'][key]
-            # Mapping needs to be a list for each node and each list item
-            # is a 2 element list (or a dictionary?)
-            LOGGER.info('MAPPING %s to %s' % (vval, key))
-
-            if vmap[0] == 'temperature':
-                self.temperature_list[vmap[1]] = 'I_TEMP_F' if self.units == 'us' else 'I_TEMP_C'
-                self.map[vval] = {
-                        'node': 'temperature',
-                        'driver': write_profile.TEMP_DRVS[vmap[1]],
-                        'units': self.temperature_list[vmap[1]]
-                        }
-
-            elif vmap[0] == 'humidity':
-                self.humidity_list[vmap[1]] = 'I_HUMIDITY'
-                self.map[vval] = {
-                        'node': 'humidity',
-                        'driver': write_profile.HUMD_DRVS[vmap[1]],
-                        'units': self.humidity_list[vmap[1]]
-                        }
-
-            elif vmap[0] == 'pressure':
-                if vmap[1] == 'trend':
-                    self.pressure_list[vmap[1]] = 'I_TREND'
-                else:
-                    self.pressure_list[vmap[1]] = 'I_INHG' if self.units == 'us' else 'I_MB'
-                self.map[vval] = {
-                        'node': 'pressure',
-                        'driver': write_profile.PRES_DRVS[vmap[1]],
-                        'units': self.pressure_list[vmap[1]]
-                        }
-
-            elif vmap[0] == 'wind':
-                if 'speed' in vmap[1]:
-                    self.wind_list[vmap[1]] = 'I_KPH' if self.units == 'metric' else 'I_MPH'
-                else:
-                    self.wind_list[vmap[1]] = 'I_DEGREE'
-                self.map[vval] = {
-                        'node': 'wind',
-                        'driver': write_profile.WIND_DRVS[vmap[1]],
-                        'units': self.wind_list[vmap[1]]
-                        }
-
-            elif vmap[0] == 'rain':
-                if 'rate' in vmap[1]:
-                    self.rain_list[vmap[1]] = 'I_MMHR' if self.units == 'metric' else 'I_INHR'
-                else:
-                    self.rain_list[vmap[1]] = 'I_MM' if self.units == 'metric' else 'I_INCHES'
-                self.map[vval] = {
-                        'node': 'rain',
-                        'driver': write_profile.RAIN_DRVS[vmap[1]],
-                        'units': self.rain_list[vmap[1]]
-                        }
-
-            elif vmap[0] == 'light':
-                self.light_list[vmap[1]] = write_profile.LITE_EDIT[vmap[1]]
-                self.map[vval] = {
-                        'node': 'light',
-                        'driver': write_profile.LITE_DRVS[vmap[1]],
-                        'units': self.light_list[vmap[1]]
-                        }
-
-            elif vmap[0] == 'lightning':
-                if 'strike' in vmap[1]:
-                    self.lightning_list[vmap[1]] = 'I_STRIKES'
-                else:
-                    self.lightning_list[vmap[1]] = 'I_KM' if self.units == 'metric' else 'I_MILE'
-                self.map[vval] = {
-                        'node': 'lightning',
-                        'driver': write_profile.LTNG_DRVS[vmap[1]],
-                        'units': self.lightning_list[vmap[1]]
-                        }
+            sid = ''
+            name = key
+            if '.' in key:
+                sid, name = key.split('.', 1)
+            if sid not in self.stations:
+                LOGGER.error('No station %s for %s' % (sid, key))
+                continue
+            if sid not in sids:
+                continue
+
+            self.map_value(self.stations[sid], name, config['customParams'][key])
+
+        # Compile the mappings and swap them in for the data processors
+        for sid in sids:
+            station = self.stations[sid]
+            self.map_trend(station)
+            station.processor.incoming = station.incoming
+            station.processor.plan = mapping.compile_plan(station.map)
+            station.derived.configure(set(station.derived_map),
+                    station.address, station.incoming, station.elevation)
+            station.stats.configure(station.derived_map, station.address)
+            station.rain.configure(station.derived_map, station.address)
 
         # Build the node definition
         LOGGER.info('Try to create node definition profile based on config.')
-        write_profile.write_profile(LOGGER, self.temperature_list,
-                self.humidity_list, self.pressure_list, self.wind_list,
-                self.rain_list, self.light_list, self.lightning_list)
+        lists = self.stations[''].lists
+        stations = {}
+        for sid in self.stations:
+            if sid != '':
+                stations[sid] = self.stations[sid].lists
+        # Reloading the profile on the ISY is slow, skip it when nothing
+        # in the profile changed.
+        digest = write_profile.profile_hash(LOGGER, lists, stations)
+        if digest is not None and digest == self.get_saved_profile() and \
+                os.path.exists(write_profile.PROFILE_ZIP):
+            LOGGER.info('Profile unchanged, not updating the ISY.')
+            return
+
+        if not write_profile.write_profile(LOGGER, lists['temperature'],
+                lists['humidity'], lists['pressure'], lists['wind'],
+                lists['rain'], lists['light'], lists['lightning'], stations):
+            return
 
         # push updated profile to ISY
         try:
             self.poly.installprofile()
         except:
             LOGGER.error('Failed up push profile to ISY')
+            return
+
+        if digest is not None:
+            try:
+                self.save_custom_data('profile', digest)
+            except:
+                LOGGER.error('Failed to save the profile hash')
+
+    # If the weather software doesn't send the pressure trend, calculate
+    # it from the pressure history.
+    def map_trend(self, station):
+        pressure = station.lists['pressure']
+        if 'trend' in pressure:
+            return
+        if 'station' in pressure or 'sealevel' in pressure:
+            self.map_value(station, 'pressure-trend', 'derived')
+
+    def map_value(self, station, key, vval):
+        lists = station.lists
+        units = station.units
+
+        vmap = key.split('-')
+        # Mapping needs to be a list for each node and each list item
+        # is a 2 element list (or a dictionary?)
+        LOGGER.info('MAPPING %s to %s' % (vval, key))
+
+        # An unknown node value would break the profile
+        if len(vmap) != 2 or vmap[0] not in write_profile.NODE_DRVS or \
+                (vmap[1] not in write_profile.NODE_DRVS[vmap[0]] and
+                (vmap[0] != 'rain' or vmap[1] not in rain.INPUTS)):
+            LOGGER.error('Unknown node value %s' % key)
+            self.addNotice('Unknown node value %s' % key)
+            return
+
+        # Derived values are calculated by the node server instead of
+        # coming from the weather software.
+        # The weather software values are keyed by node value since a
+        # field can be mapped to more than one, derived values by metric.
+        target = station.map
+        name = key
+        window = None
+        if vval.startswith('derived:'):
+            vval, window = vval.split(':', 1)
+            try:
+                window = stats.parse_window(window)
+            except ValueError as e:
+                LOGGER.error('%s: %s' % (key, str(e)))
+                self.addNotice('%s: %s' % (key, str(e)))
+                return
+        if vval == 'derived':
+            if tuple(vmap[:2]) not in stats.STATISTICS and \
+                    (vmap[0] != 'rain' or vmap[1] not in rain.OUTPUTS) and \
+                    derived.NODE_METRICS.get(vmap[1]) != vmap[0] and \
+                    (vmap[1] not in derived.METRICS or
+                    derived.METRICS[vmap[1]][0] != vmap[0]):
+                LOGGER.error('%s can not be derived' % key)
+                self.addNotice('%s can not be derived' % key)
+                return
+            if window is not None and tuple(vmap[:2]) not in stats.STATISTICS:
+                LOGGER.error('%s does not use a window' % key)
+                self.addNotice('%s does not use a window' % key)
+                return
+            if window == stats.DAILY and \
+                    stats.STATISTICS[tuple(vmap[:2])][1] is None:
+                LOGGER.error('%s needs a time window' % key)
+                self.addNotice('%s needs a time window' % key)
+                return
+            target = station.derived_map
+            name = vmap[1]
+        else:
+            # A field or an expression of fields
+            try:
+                mapping.compile_source(vval)
+            except ValueError as e:
+                LOGGER.error('%s: %s' % (key, str(e)))
+                self.addNotice('%s: %s' % (key, str(e)))
+                return
+
+        if vmap[0] == 'temperature':
+            lists['temperature'][vmap[1]] = 'I_TEMP_F' if units == 'us' else 'I_TEMP_C'
+            target[name] = {
+                    'node': 'temperature',
+                    'driver': write_profile.TEMP_DRVS[vmap[1]],
+                    'units': lists['temperature'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'humidity':
+            lists['humidity'][vmap[1]] = 'I_HUMIDITY'
+            target[name] = {
+                    'node': 'humidity',
+                    'driver': write_profile.HUMD_DRVS[vmap[1]],
+                    'units': lists['humidity'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'pressure':
+            if vmap[1] == 'trend':
+                lists['pressure'][vmap[1]] = 'I_TREND'
+            else:
+                lists['pressure'][vmap[1]] = 'I_INHG' if units == 'us' else 'I_MB'
+            target[name] = {
+                    'node': 'pressure',
+                    'driver': write_profile.PRES_DRVS[vmap[1]],
+                    'units': lists['pressure'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'wind':
+            if 'speed' in vmap[1]:
+                lists['wind'][vmap[1]] = 'I_KPH' if units == 'metric' else 'I_MPH'
+            else:
+                lists['wind'][vmap[1]] = 'I_DEGREE'
+            target[name] = {
+                    'node': 'wind',
+                    'driver': write_profile.WIND_DRVS[vmap[1]],
+                    'units': lists['wind'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'rain' and vmap[1] in rain.INPUTS:
+            # Rain counter/increment only feeds the rain totals
+            target[name] = {
+                    'node': 'rain',
+                    'driver': vmap[1],
+                    'units': None,
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'rain':
+            if 'rate' in vmap[1]:
+                lists['rain'][vmap[1]] = 'I_MMHR' if units == 'metric' else 'I_INHR'
+            else:
+                lists['rain'][vmap[1]] = 'I_MM' if units == 'metric' else 'I_INCHES'
+            target[name] = {
+                    'node': 'rain',
+                    'driver': write_profile.RAIN_DRVS[vmap[1]],
+                    'units': lists['rain'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'light':
+            lists['light'][vmap[1]] = write_profile.LITE_EDIT[vmap[1]]
+            target[name] = {
+                    'node': 'light',
+                    'driver': write_profile.LITE_DRVS[vmap[1]],
+                    'units': lists['light'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        elif vmap[0] == 'lightning':
+            if 'strike' in vmap[1]:
+                lists['lightning'][vmap[1]] = 'I_STRIKES'
+            else:
+                lists['lightning'][vmap[1]] = 'I_KM' if units == 'metric' else 'I_MILE'
+            target[name] = {
+                    'node': 'lightning',
+                    'driver': write_profile.LTNG_DRVS[vmap[1]],
+                    'units': lists['lightning'][vmap[1]],
+                    'address': station.address(vmap[0]),
+                    }
+
+        # Rolling statistics remember their window
+        if window is not None:
+            target[name]['window'] = window
+        if target is station.map:
+            target[name]['source'] = vval
 
     def remove_notices_all(self,command):
         LOGGER.info('remove_notices_all:')
@@ -403,13 +872,18 @@ class Controller(polyinterface.Controller):
         return st
 
     def web_server(self):
+        # Requests are queued by the web server on the station's queue
+        # and processed by the station's dispatcher thread.
         # Implement web server here
         try:
             #self.server = http.server.HTTPServer(('', self.port), weather_data_handler)
-            self.server = Server(('', self.port), weather_data_handler)
-            LOGGER.info('Started web server on port %d' % self.port)
+            self.server = Server(('', self.port), weather_data_handler,
+                    self.stations, self.workers, self.max_requests,
+                    self.history)
+            LOGGER.info('Started web server on port %d (%d workers, %d max requests)' %
+                    (self.port, self.workers, self.max_requests))
             self_server_running = True
-            self.server.serve_forever(self.map, self.nodes)
+            self.server.serve_forever()
         except Exception as e:
             LOGGER.error('Web server failed to start. {}'.format(e))
             #self.server.socket.close()
@@ -417,10 +891,136 @@ class Controller(polyinterface.Controller):
             self.addNotice("Failed to start weather monitoring service.")
             
 
+    def weatherflow_listener(self):
+        # Runs alongside the web server when a station is configured to
+        # get data from a WeatherFlow hub.
+        if self.wf_listener is not None or not self.wf_hubs:
+            return
+        try:
+            self.wf_listener = weatherflow.Listener(self.weatherflow_route,
+                    LOGGER, self.wf_port)
+            self.wf_listener.start()
+        except Exception as e:
+            LOGGER.error('WeatherFlow listener failed to start. {}'.format(e))
+            self.wf_listener = None
+            self.addNotice("Failed to start WeatherFlow listener.")
+
+    def realtime_watcher(self):
+        # Watch the realtime files of stations configured to read them
+        # locally instead of receiving data over HTTP.
+        if self.rt_watcher is not None or not self.rt_files:
+            return
+        self.rt_watcher = realtime.FileWatcher(LOGGER)
+        self.rt_watcher.configure(self.rt_files, self.rt_interval)
+        self.rt_watcher.start()
+
+    # The MQTT connection state of the polyglot interface
+    def poly_connected(self):
+        return getattr(self.poly, 'connected', True)
+
+    def send_held(self, address, driver, value):
+        node = self.nodes.get(address)
+        if isinstance(node, WeatherNode):
+            node.send(driver, value)
+
+    def history_store(self):
+        # Record the node values when HistoryDays is set and compact
+        # them into the summary tiers.
+        if self.history.days and not self.history.is_alive():
+            if self.history.ident is not None:
+                # A thread can't be started again, replace a store that
+                # stopped (I.E. its directory couldn't be created).
+                days = self.history.days
+                self.history = history.HistoryStore(LOGGER)
+                self.history.configure(days)
+                self.history.compactor = self.compactor
+                self.compactor.store = self.history
+                if self.server is not None:
+                    self.server.history = self.history
+            self.history.start()
+        if self.history.days and self.compactor.enabled() and \
+                self.compactor.ident is None:
+            self.compactor.start()
+
+    def weatherflow_route(self, hub):
+        hubs = self.wf_hubs
+        station = hubs.get(hub, hubs.get('any'))
+        if station is None:
+            return None
+        return station.ingest
+
     def SetUnits(self, u, i):
         self.units = u
         self.units_in = i
 
+    # Save the runtime state (driver values, trend history and
+    # statistics) for a warm restart.  The rain totals are saved to the
+    # custom data by save_rain.
+    def save_snapshot(self):
+        state = {'nodes': {}, 'trend': {}, 'stats': {}}
+        for address in list(self.nodes):
+            node = self.nodes[address]
+            if not isinstance(node, WeatherNode):
+                continue
+            values = {}
+            for d in node.drivers:
+                values[d['driver']] = (d['value'], d['uom'],
+                        node.updated.get(d['driver']))
+            state['nodes'][address] = values
+            if isinstance(node, PressureNode):
+                state['trend'][address] = node.trend.state()
+
+        for sid in list(self.stations):
+            state['stats'][sid] = self.stations[sid].stats.state()
+
+        try:
+            snapshot.save(state)
+        except Exception as e:
+            LOGGER.error('Failed to save snapshot: %s' % str(e))
+
+    def restore_snapshot(self):
+        state = snapshot.load(LOGGER)
+        if state is None:
+            return
+
+        for sid in self.stations:
+            station = self.stations[sid]
+            try:
+                if sid in state['stats']:
+                    station.stats.restore(state['stats'][sid])
+            except Exception as e:
+                LOGGER.error('Failed to restore station %s: %s' %
+                        (sid or 'default', str(e)))
+
+        for address in state['nodes']:
+            node = self.nodes.get(address)
+            if not isinstance(node, WeatherNode):
+                continue
+            try:
+                values = state['nodes'][address]
+                restored = {}
+                for d in node.drivers:
+                    if d['driver'] in values:
+                        value, units, updated = values[d['driver']]
+                        # Units changed while stopped, the value is
+                        # in the old units.
+                        if units != d['uom']:
+                            continue
+                        restored[d['driver']] = (float(value), updated)
+                if address in state['trend'] and isinstance(node, PressureNode):
+                    node.trend.restore(state['trend'][address])
+            except Exception as e:
+                LOGGER.error('Failed to restore node %s: %s' % (address, str(e)))
+                continue
+            for d in node.drivers:
+                if d['driver'] in restored:
+                    d['value'], updated = restored[d['driver']]
+                    if isinstance(updated, (int, float)):
+                        node.updated[d['driver']] = updated
+            node.reportDrivers()
+
+        LOGGER.info('Restored state from snapshot')
+
     def get_saved_log_level(self):
         if 'customData' in self.polyConfig:
             if 'level' in self.polyConfig['customData']:
@@ -429,10 +1029,43 @@ class Controller(polyinterface.Controller):
         return 0
 
     def save_log_level(self, level):
-        level_data = {
-            'level': level,
-            }
-        self.poly.saveCustomData(level_data)
+        self.save_custom_data('level', level)
+
+    # Custom data holds the log level, the rain totals and the profile
+    # hash, update one without losing the others.
+    def save_custom_data(self, key, value):
+        data = {}
+        if 'customData' in self.polyConfig:
+            data.update(self.polyConfig['customData'])
+        data[key] = value
+        self.polyConfig['customData'] = data
+        self.poly.saveCustomData(data)
+
+    def get_saved_profile(self):
+        if 'customData' in self.polyConfig:
+            if 'profile' in self.polyConfig['customData']:
+                return self.polyConfig['customData']['profile']
+        return None
+
+    def get_saved_rain(self):
+        if 'customData' in self.polyConfig:
+            if 'rain' in self.polyConfig['customData']:
+                return self.polyConfig['customData']['rain']
+        return {}
+
+    def save_rain(self):
+        totals = dict(self.get_saved_rain())
+        changed = False
+        for sid in list(self.stations):
+            state = self.stations[sid].rain.state()
+            if state is not None:
+                totals[sid] = state
+                changed = True
+        if changed:
+            try:
+                self.save_custom_data('rain', totals)
+            except:
+                LOGGER.error('Failed to save the rain totals')
 
     def set_logging_level(self, level=None):
         if level is None:
@@ -475,17 +1108,102 @@ class Controller(polyinterface.Controller):
             ]
 
 
-class TemperatureNode(polyinterface.Node):
-    id = 'temperature'
-    hint = 0xffffff
+class WeatherNode(polyinterface.Node):
+    """
+    Base class for the sensor nodes. Driver updates are passed through
+    the controller's publish filter and only sent to the ISY when the
+    value moved outside its deadband or hasn't been sent for a while.
+
+    When coalescing is enabled, updates are held by the controller's
+    coalescer and published in a batch per node when it flushes.
+
+    The controller's scheduler limits how often each driver is published
+    and in which order waiting updates go out, publish_policy is the
+    node type's (minimum interval, maximum interval, priority) per
+    driver, None for the default.
+
+    Every value is also recorded in the controller's history store.
+    While Polyglot can't be reached, updates are held in the
+    controller's outbox.
+    """
+    kind = None
     units = 'metric'
-    units_in = 'metric'
-    drivers = [ ]
+    units_in = uom.INCOMING['metric']
+    converters = {}
+    publish_policy = {}
+
+    def __init__(self, controller, primary, address, name):
+        super(WeatherNode, self).__init__(controller, primary, address, name)
+        # driver -> time the last value was set
+        self.updated = {}
 
+    # units is the display units, units_in the units of each quantity
+    # in the incoming data.
     def SetUnits(self, u, i):
         self.units = u
         self.units_in = i
 
+    # Bind the unit conversion of each driver, driver -> function
+    # from uom.driver_converter() or None.
+    def SetConverters(self, converters):
+        self.converters = converters
+
+    # Convert a value from incoming units to the driver's display units
+    def convert(self, driver, value):
+        convert = self.converters.get(driver)
+        if convert is None:
+            return value
+        return convert(value)
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None):
+        self.updated[driver] = time.time()
+        self.controller.history.record(self.address, driver, value)
+        if report and self.controller.coalescer.enabled:
+            self.controller.coalescer.add(self, driver, value)
+            return
+        self.publish(driver, value, report, force, uom)
+
+    def publish(self, driver, value, report=True, force=True, uom=None):
+        scheduler = self.controller.scheduler
+        if report and not self.controller.publish_filter.accept(
+                self.address, self.kind, driver, value,
+                silence=scheduler.policy(self, driver)[1]):
+            return
+        if report and not scheduler.submit(self, driver, value):
+            return
+        self.deliver(driver, value, report, force, uom)
+
+    def deliver(self, driver, value, report=True, force=True, uom=None):
+        # Hold the update while Polyglot can't be reached
+        held = self.controller.outbox
+        if held.holding():
+            held.hold(self.address, driver, value)
+            return
+        try:
+            self.send(driver, value, report, force, uom)
+        except Exception as e:
+            LOGGER.warning('Failed to send %s %s, holding it: %s' %
+                    (self.address, driver, str(e)))
+            held.hold(self.address, driver, value)
+
+    def send(self, driver, value, report=True, force=True, uom=None):
+        super(WeatherNode, self).setDriver(driver, value, report, force, uom)
+
+    def publish_batch(self, updates):
+        for driver in updates:
+            self.publish(driver, updates[driver])
+
+
+class TemperatureNode(WeatherNode):
+    id = 'temperature'
+    kind = 'temperature'
+    hint = 0xffffff
+    drivers = [ ]
+    # Soil temperature changes a few times a day
+    publish_policy = {
+            'GV17' : (300, None, publish.PRIORITIES['low']),
+            }
+
     # Assumes temp in C
     def Dewpoint(self, t, h):
         b = (17.625 * t) / (243.04 + t)
@@ -533,48 +1251,49 @@ class TemperatureNode(polyinterface.Node):
         else:
             return round((hi - 32) / 1.8, 1)
 
-    # Convert temperature from incoming units to display units
-    def convert(self, value):
-        if self.units_in == 'us':
-            if self.units != 'us':
-                return round((value - 32) / 1.8, 2) # to C
-        else:
-            if self.units == 'us':
-                return round((value * 1.8) + 32, 2) # to F
-        return value
-
     def setDriver(self, driver, value):
-        value = self.convert(value)
+        value = self.convert(driver, value)
         super(TemperatureNode, self).setDriver(driver, round(value, 1), report=True, force=True)
 
 
 
-class HumidityNode(polyinterface.Node):
+class HumidityNode(WeatherNode):
     id = 'humidity'
+    kind = 'humidity'
     hint = 0xffffff
-    units = 'metric'
-    units_in = 'metric'
     drivers = [{'driver': 'ST', 'value': 0, 'uom': 22}]
 
-    def SetUnits(self, u, i):
-        self.units = u
-        self.units_in = i
-
     def setDriver(self, driver, value):
         super(HumidityNode, self).setDriver(driver, value, report=True, force=True)
 
-class PressureNode(polyinterface.Node):
+class PressureNode(WeatherNode):
     id = 'pressure'
+    kind = 'pressure'
     hint = 0xffffff
-    units = 'metric'
-    units_in = 'metric'
     drivers = [ ]
-    mytrend = []
+    publish_policy = {
+            None : (0, None, publish.PRIORITIES['low']),
+            }
+    trend_driver = None
+    trend_source = 'ST'
 
+    to_mb = None
+
+    def __init__(self, controller, primary, address, name):
+        super(PressureNode, self).__init__(controller, primary, address, name)
+        self.trend = trend.TrendBuffer()
 
     def SetUnits(self, u, i):
-        self.units = u
-        self.units_in = i
+        super(PressureNode, self).SetUnits(u, i)
+        self.to_mb = uom.converter('pressure', i['pressure'], 'mb')
+
+    # Calculate the trend (GV1) from the pressure history when the
+    # weather software doesn't send it. window is in seconds, threshold
+    # in mb. source is the driver (station or sealevel) to track.
+    def SetTrend(self, window, threshold, calculate, source='ST'):
+        self.trend.configure(window, threshold)
+        self.trend_driver = 'GV1' if calculate else None
+        self.trend_source = source
 
     # convert station pressure in millibars to sealevel pressure
     def toSeaLevel(self, station, elevation):
@@ -590,170 +1309,93 @@ class PressureNode(polyinterface.Node):
 
         return (round((station * u), 3))
 
-    # track pressures in a queue and calculate trend
+    # track pressures (in mb) and calculate trend
     def updateTrend(self, current):
-        t = 0
-        past = 0
+        return self.trend.add(current)
 
-        if len(self.mytrend) == 180:
-            past = self.mytrend.pop()
-
-        if self.mytrend != []:
-            past = self.mytrend[0]
-
-        # calculate trend
-        if ((past - current) > 1):
-            t = -1
-        elif ((past - current) < -1):
-            t = 1
-
-        self.mytrend.insert(0, current)
-        return t
-
-    def convert(self, value):
-        if self.units_in == 'us':
-            if self.units != 'us':
-                return round(value / 0.02952998751, 3)
-        else:
-            if self.units == 'us':
-                return round(value * 0.02952998751, 3)
-        return value
-        
     # We want to override the SetDriver method so that we can properly
     # convert the units based on the user preference.
     def setDriver(self, driver, value):
-        value = self.convert(value)
+        if self.trend_driver is not None and driver == self.trend_source:
+            mb = value if self.to_mb is None else self.to_mb(value)
+            super(PressureNode, self).setDriver(self.trend_driver,
+                    self.updateTrend(mb), report=True, force=True)
+
+        value = self.convert(driver, value)
         super(PressureNode, self).setDriver(driver, value, report=True, force=True)
 
 
-class WindNode(polyinterface.Node):
+class WindNode(WeatherNode):
     id = 'wind'
+    kind = 'wind'
     hint = 0xffffff
-    units = 'metric'
-    units_in = 'metric'
     drivers = [ ]
-
-    def SetUnits(self, u, i):
-        self.units = u
-        self.units_in = i
-
-    def convert(self, value):
-        if self.units_in == 'us' or self.units_in == 'uk':
-            if self.units == 'metric':
-                return round(value * 1.609344, 2)
-        else:
-            if self.units == 'us' or self.units == 'uk':
-                return round(value / 1.609344, 2)
-        return value
+    # Speed and direction change all the time
+    publish_policy = {
+            'ST' : (0, None, publish.PRIORITIES['high']),
+            'GV0' : (0, None, publish.PRIORITIES['high']),
+            None : (0, None, publish.PRIORITIES['normal']),
+            }
 
     def setDriver(self, driver, value):
-        if (driver == 'ST' or driver == 'GV1' or driver == 'GV3'):
-            value = self.convert(value)
+        value = self.convert(driver, value)
         super(WindNode, self).setDriver(driver, value, report=True, force=True)
 
-class PrecipitationNode(polyinterface.Node):
+class PrecipitationNode(WeatherNode):
     id = 'precipitation'
+    kind = 'rain'
     hint = 0xffffff
-    units = 'metric'
-    units_in = 'metric'
     drivers = [ ]
-    hourly_rain = 0
-    daily_rain = 0
-    weekly_rain = 0
-    monthly_rain = 0
-    yearly_rain = 0
-
-    prev_hour = 0
-    prev_day = 0
-    prev_week = 0
-
-    def SetUnits(self, u, i):
-        self.units = u
-        self.units_in = i
-
-    def hourly_accumulation(self, r):
-        current_hour = datetime.datetime.now().hour
-        if (current_hour != self.prev_hour):
-            self.prev_hour = current_hour
-            self.hourly = 0
-
-        self.hourly_rain += r
-        return self.hourly_rain
-
-    def daily_accumulation(self, r):
-        current_day = datetime.datetime.now().day
-        if (current_day != self.prev_day):
-            self.prev_day = current_day
-            self.daily_rain = 0
-
-        self.daily_rain += r
-        return self.daily_rain
-
-    def weekly_accumulation(self, r):
-        current_week = datetime.datetime.now().day
-        if (current_weekday != self.prev_weekday):
-            self.prev_week = current_weekday
-            self.weekly_rain = 0
-
-        self.weekly_rain += r
-        return self.weekly_rain
-
-    def convert(self, value):
-        if self.units_in == 'us':
-            if self.units != 'us':
-                return round(value / 0.03937, 2)
-        else:
-            if self.units == 'us':
-                return round(value * 0.03937, 2)
-        return value
+    # The totals change slowly, the rate is what matters when it rains
+    publish_policy = {
+            'ST' : (0, None, publish.PRIORITIES['high']),
+            None : (60, None, publish.PRIORITIES['low']),
+            }
 
-        
     def setDriver(self, driver, value):
-        value = self.convert(value)
+        # The rain counter/increment only feed the rain totals
+        if driver in rain.INPUTS:
+            return
+        value = self.convert(driver, value)
         super(PrecipitationNode, self).setDriver(driver, value, report=True, force=True)
 
-class LightNode(polyinterface.Node):
+class LightNode(WeatherNode):
     id = 'light'
-    units = 'metric'
-    units_in = 'metric'
+    kind = 'light'
     hint = 0xffffff
     drivers = [ ]
 
-    def SetUnits(self, u, i):
-        self.units = u
-        self.units_in = i
-
     def setDriver(self, driver, value):
         super(LightNode, self).setDriver(driver, value, report=True, force=True)
 
-class LightningNode(polyinterface.Node):
+class LightningNode(WeatherNode):
     id = 'lightning'
+    kind = 'lightning'
     hint = 0xffffff
-    units = 'metric'
-    units_in = 'metric'
     drivers = [ ]
-
-    def SetUnits(self, u, i):
-        self.units = u
-        self.units_in = i
-
-    def convert(self, value):
-        if self.units_in == 'us' or self.units_in == 'uk':
-            if self.units == 'metric':
-                return round(value * 1.609344, 1)
-        else:
-            if self.units == 'us' or self.units == 'uk':
-                return round(value / 1.609344, 1)
-        return value
+    publish_policy = {
+            None : (0, None, publish.PRIORITIES['high']),
+            }
 
     def setDriver(self, driver, value):
-        if (driver == 'GV0'):
-            value = self.convert(value)
+        value = self.convert(driver, value)
         super(LightningNode, self).setDriver(driver, value, report=True, force=True)
 
+# Node type, node class and node name for each of the sensor nodes
+NODE_TYPES = (
+        ('temperature', TemperatureNode, 'Temperatures'),
+        ('humidity', HumidityNode, 'Humidity'),
+        ('pressure', PressureNode, 'Barometric Pressure'),
+        ('wind', WindNode, 'Wind'),
+        ('rain', PrecipitationNode, 'Precipitation'),
+        ('light', LightNode, 'Illumination'),
+        ('lightning', LightningNode, 'Lightning'),
+        )
+
+
 class weather_data_handler(http.server.BaseHTTPRequestHandler):
-    node_map = {}
-    nodes = {}
+    # Drop clients that stall mid-request so they don't tie up a worker
+    timeout = 10
 
     def log_message(self, format, *args):
         LOGGER.info("%s" % format%args)
@@ -763,9 +1405,14 @@ class weather_data_handler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
         message = "<head></head><body>Successful data submission</body>\n"
 
-        # may want to move this below the response so we don't make
-        # the client wait.
-        self.process_data(self.path)
+        if self.path.split('?')[0] == '/history':
+            self.history()
+            return
+
+        # Queue the request for the station's dispatcher so we don't
+        # make the client wait.
+        queue, path = self.server.route(self.path)
+        queue.put((path, None))
 
         self.send_response(200)  # OK
         self.send_header("Content-type", "text/html")
@@ -774,13 +1421,95 @@ class weather_data_handler(http.server.BaseHTTPRequestHandler):
 
         return
 
+    # /history?node=<address>&driver=<driver>&start=<time>&end=<time>
+    #     &step=<seconds>&format=<json|csv>
+    #
+    # Returns the min/mean/max/count of the recorded values for each step
+    # seconds. Times are Unix time stamps, the default is the last day in
+    # 60 second steps.  The response is sent in chunks as it's read.
+    def history(self):
+        store = self.server.history
+        if store is None or not store.days:
+            self.send_error(404, 'History is not being recorded')
+            return
+
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            node = query['node'][0]
+            driver = query['driver'][0]
+            end = float(query['end'][0]) if 'end' in query else time.time()
+            start = float(query['start'][0]) if 'start' in query else end - 86400
+            step = float(query['step'][0]) if 'step' in query else 60
+            fmt = query['format'][0] if 'format' in query else 'json'
+            if not step > 0 or not start <= end or fmt not in ('json', 'csv'):
+                raise ValueError()
+        except (KeyError, ValueError):
+            self.send_error(400, 'Need node and driver, optional start, end, step and format (json or csv)')
+            return
+
+        rows = history.downsample(store.query(node, driver, start, end, step), step)
+
+        # Chunked transfer encoding needs HTTP/1.1, HTTP/1.0 clients get
+        # a body that ends when the connection is closed.
+        self.chunked = self.request_version != 'HTTP/1.0'
+        if self.chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.close_connection = True
+        self.send_response(200)
+        if fmt == 'csv':
+            self.send_header("Content-type", "text/csv")
+        else:
+            self.send_header("Content-type", "application/json")
+        if self.chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        chunk = []
+        size = 0
+        if fmt == 'csv':
+            chunk.append('time,min,mean,max,count\n')
+        else:
+            chunk.append('{"node": %s, "driver": %s, "step": %s, "data": [' %
+                    (json.dumps(node), json.dumps(driver), json.dumps(step)))
+        first = True
+        for row in rows:
+            if fmt == 'csv':
+                line = '%d,%s,%s,%s,%d\n' % (row[0], row[1],
+                        round(row[2], 3), row[3], row[4])
+            else:
+                line = '%s[%d, %s, %s, %s, %d]' % ('' if first else ', ',
+                        row[0], row[1], round(row[2], 3), row[3], row[4])
+            first = False
+            chunk.append(line)
+            size += len(line)
+            if size >= 8192:
+                self.write_chunk(''.join(chunk))
+                chunk = []
+                size = 0
+        if fmt == 'json':
+            chunk.append(']}\n')
+        self.write_chunk(''.join(chunk))
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, text):
+        data = text.encode('utf_8')
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(('%x\r\n' % len(data)).encode('ascii') + data + b'\r\n')
+        else:
+            self.wfile.write(data)
+
     def do_POST(self):
         message = "<head></head><body>Successful data submission</body>\n"
 
         content_length = int(self.headers['content-Length'])
         post_data = self.rfile.read(content_length)
 
-        self.process_post_data(self.path, post_data)
+        queue, path = self.server.route(self.path)
+        queue.put((path, post_data))
 
         self.send_response(200)  # OK
         self.send_header("Content-type", "text/html")
@@ -789,6 +1518,43 @@ class weather_data_handler(http.server.BaseHTTPRequestHandler):
 
         return
 
+
+class DataProcessor(object):
+    """
+    Parse the data queued by the web server and update the node drivers.
+    Only the dispatcher thread calls into this.
+
+    The parse plan is compiled by Controller.map_nodes and replaced as a
+    whole when the configuration changes. Each request reads self.plan
+    once so it never sees a partially built mapping.
+    """
+    plan = mapping.EMPTY_PLAN
+    wf_plan = (None, {})
+    incoming = uom.INCOMING['metric']
+    nodes = {}
+    controller = None
+    # time data was last processed
+    seen = None
+
+    def process(self, item):
+        path, post_data = item
+        self.seen = time.time()
+        if post_data is None:
+            self.process_data(path)
+        else:
+            self.process_post_data(path, post_data)
+
+        # Recalculate any derived values whose inputs changed
+        self.derived.flush(self.nodes)
+        self.stats.flush(self.nodes)
+        self.rain.flush(self.nodes)
+
+    # Feed a value to the derived values, statistics and rain totals
+    def observe(self, node, driver, value):
+        self.derived.update(node, driver, value)
+        self.stats.update(node, driver, value)
+        self.rain.update(node, driver, value)
+
     def process_data(self, path):
         # split the path into path/query components
         c = path.split('?')
@@ -814,30 +1580,83 @@ class weather_data_handler(http.server.BaseHTTPRequestHandler):
     def process_post_data(self, path, data):
         if 'weewx' in path:
             self.weewx(data)
+        elif path == 'weatherflow':
+            # Decoded UDP broadcast from a WeatherFlow hub
+            self.weatherflow(data)
+        elif path == 'realtime':
+            # Contents of a local realtime.txt/clientraw.txt file
+            self.realtime(data)
         return
 
-    def meteobridge(self, data):
-        # key = 'd'
-        # data[key] = space separated list
-        # Use node-value to field # mapping
-        for key in data:
-            fields = data[key][0].split(' ')
-            for f in self.node_map:
-                try:
-                    i = int(f)
-                except: 
-                    continue
+    # Split a space separated list only as far as the last mapped field
+    def split_fields(self, plan, text, sep=' '):
+        if not plan.width:
+            return []
+        return text.split(sep, plan.width)
+
+    # Run the compiled positional plan over a list of fields
+    def run_fields(self, plan_fields, fields, exprs=()):
+        count = len(fields)
+        for i, node, driver, convert in plan_fields:
+            if i >= count:
+                break
+            try:
+                value = convert(fields[i])
+                LOGGER.debug(' - Set %s driver %s to %s', node, driver, value)
+                self.nodes[node].setDriver(driver, value)
+                self.observe(node, driver, value)
+            except Exception as e:
+                LOGGER.debug('  - setDriver failed %d  -> %s %s' % (i, node, str(e)))
+        if exprs:
+            self.run_exprs(exprs, fields.__getitem__)
 
-                m = self.node_map[f]
+    # Run the compiled key plan over the query data
+    def run_keys(self, plan, data):
+        for key in data:
+            try:
+                targets = plan.keys[key]
+            except KeyError:
+                LOGGER.info('map has %d entries, but not %s' % (len(plan.keys), key))
+                continue
 
+            for node, driver, convert in targets:
                 try:
-                    LOGGER.info(' - Set %s driver %s to %s' % 
-                        (self.node_map[f]['node'], self.node_map[f]['driver'], fields[i]))
-
-                    self.nodes[m['node']].setDriver(m['driver'], float(fields[i]))
+                    value = convert(data[key][0])
+                    LOGGER.debug(' - Set %s driver %s to %s', node, driver, value)
+                    self.nodes[node].setDriver(driver, value)
+                    self.observe(node, driver, value)
                 except Exception as e:
-                    LOGGER.debug('  - setDriver failed %s  -> %s %s' % (f, m['node'], str(e)))
+                    LOGGER.error('  - setDriver failed %s  -> %s %s' % (key, node, str(e)))
+        if plan.key_exprs:
+            self.run_exprs(plan.key_exprs, lambda key: data[key][0])
+
+    # Run the compiled expressions, lookup returns the raw value of an
+    # input.  Expressions with an input missing from the data are skipped.
+    def run_exprs(self, exprs, lookup):
+        for inputs, converters, function, node, driver in exprs:
+            try:
+                value = function([convert(lookup(i))
+                    for i, convert in zip(inputs, converters)])
+            except LookupError:
+                continue
+            except (ValueError, TypeError, ArithmeticError) as e:
+                LOGGER.debug('  - expression failed -> %s %s %s' % (node, driver, str(e)))
+                continue
+            try:
+                LOGGER.debug(' - Set %s driver %s to %s', node, driver, value)
+                self.nodes[node].setDriver(driver, value)
+                self.observe(node, driver, value)
+            except Exception as e:
+                LOGGER.debug('  - setDriver failed -> %s %s' % (node, str(e)))
 
+    def meteobridge(self, data):
+        # key = 'd'
+        # data[key] = space separated list
+        # Use node-value to field # mapping
+        plan = self.plan
+        for key in data:
+            self.run_fields(plan.fields, self.split_fields(plan, data[key][0]),
+                    plan.field_exprs)
         return
 
     def weatherdisplay(self, data):
@@ -846,111 +1665,221 @@ class weather_data_handler(http.server.BaseHTTPRequestHandler):
 
     def weewx(self, data):
         LOGGER.debug('Got some WeeWX data')
-        fields = data.decode().split(' ')
-        for f in self.node_map:
-            try:
-                i = int(f)
-            except: 
-                continue
-
-            m = self.node_map[f]
-
-            try:
-                LOGGER.info(' - Set %s driver %s to %s' % 
-                    (self.node_map[f]['node'], self.node_map[f]['driver'], fields[i]))
-
-                self.nodes[m['node']].setDriver(m['driver'], float(fields[i]))
-            except Exception as e:
-                LOGGER.debug('  - setDriver failed %s  -> %s %s' % (f, m['node'], str(e)))
+        plan = self.plan
+        self.run_fields(plan.fields, self.split_fields(plan, data.decode()),
+                plan.field_exprs)
         return
 
-    # convert cardinal direction to degrees
-    def cardinal(self, direction):
-        dirs = ["N", "NNE", "NE", "ENE", "E", "ESE", "SE", "SSE",
-            "S", "SSW", "SW", "WSW", "W", "WNW", "NW", "NNW"]
-        try:
-            ix = dirs.index(direction)
-            return ix * 22.5
-        except:
-            LOGGER.error('Cannot convert ' + direction + ' to degrees')
-            return 0
+    def realtime(self, data):
+        # Cumulus realtime.txt and Weather Display clientraw.txt are
+        # whitespace separated fields on a single line.
+        plan = self.plan
+        self.run_fields(plan.fields,
+                self.split_fields(plan, data.decode(errors='replace'), None),
+                plan.field_exprs)
+        return
 
     def cumulus(self, data):
-        # map key's to configuration node/driver
+        # map key's to configuration node/driver. Pressure trend and wind
+        # directions are sent as strings, the plan has the converters to
+        # turn those into numbers.
         LOGGER.debug('Got some cumulus data')
-        for key in data:
-            if key in self.node_map:
-                m = self.node_map[key]
-                LOGGER.info(' - Set %s driver %s to %s' % 
-                        (self.node_map[key]['node'], self.node_map[key]['driver'], data[key]))
-
-                # If pressure node trend driver the data isn't an integer but
-                # a string.  Need to covnert the string to the proper int
-                # representation of trend: 1, 2, 3
-                if m['node'] == 'pressure' and m['driver'] == 'GV1':
-                    if data[key][0] == 'Rising':
-                        val = 2
-                    elif data[key][0] == 'Falling':
-                        val = 0
-                    elif data[key][0] == 'Steady':
-                        val = 1
-                    elif data[key][0] == 'Rising slowly':
-                        val = 3
-                    elif data[key][0] == 'Rising rapidly':
-                        val = 4
-                    elif data[key][0] == 'Falling slowly':
-                        val = 5
-                    elif data[key][0] == 'Falling rapidly':
-                        val = 6
-                    else:
-                        val = 7
-                elif m['node'] == 'wind' and m['driver'] == 'GV0': # direction
-                    if data[key][0].isnumeric():
-                        val = float(data[key][0])
-                    else:
-                        val = self.cardinal(data[key][0])
-                elif m['node'] == 'wind' and m['driver'] == 'GV2': # gust dir
-                    if data[key][0].isnumeric():
-                        val = float(data[key][0])
-                    else:
-                        val = self.cardinal(data[key][0])
-                else:
-                    val = float(data[key][0])
-
-                self.nodes[m['node']].setDriver(m['driver'], val)
-            else:
-                LOGGER.info('map has %d entries, but not %s' % (len(self.node_map), key))
+        self.run_keys(self.plan, data)
         return
 
+    def weatherflow(self, message):
+        mtype = message.get('type')
+        if mtype == 'device_status':
+            self.device_status(message)
+            return
+
+        # Only the mapped fields of each message type are looked at.
+        # That plan is built from the current key plan when it changes.
+        plan = self.plan
+        if self.wf_plan[0] is not plan:
+            self.wf_plan = (plan, weatherflow.compile_plan(plan, self.incoming))
+        plan_fields, plan_exprs = self.wf_plan[1].get(mtype, ((), ()))
+        if not plan_fields and not plan_exprs:
+            return
+
+        values = message.get(weatherflow.VALUES[mtype])
+        if not values:
+            return
+        if weatherflow.VALUES[mtype] == 'obs':
+            for obs in values:
+                self.run_fields(plan_fields, obs, plan_exprs)
+        else:
+            self.run_fields(plan_fields, values, plan_exprs)
+
+    # Air/Sky/Tempest battery voltage and signal strength are reported
+    # on the controller node.
+    def device_status(self, message):
+        try:
+            drivers = weatherflow.DEVICE_DRIVERS[message['serial_number'][:2]]
+        except (KeyError, TypeError):
+            return
+
+        for battery, rssi in drivers:
+            try:
+                self.controller.setDriver(battery, message['voltage'])
+                self.controller.setDriver(rssi, message['rssi'])
+            except Exception as e:
+                LOGGER.debug('  - device status failed %s' % str(e))
+
     def acuparse(self, data):
         # map key's to configuration node/driver
         LOGGER.debug('Got some acuparse data')
-        for key in data:
-            if key in self.node_map:
-                m = self.node_map[key]
-                LOGGER.info(' - Set %s driver %s to %s' % 
-                        (self.node_map[key]['node'], self.node_map[key]['driver'], data[key]))
-
-                val = float(data[key][0])
-                self.nodes[m['node']].setDriver(m['driver'], val)
-            else:
-                LOGGER.info('map has %d entries, but not %s' % (len(self.node_map), key))
+        self.run_keys(self.plan, data)
         return
 
 
 
+class Station(object):
+    """
+    A weather station sending data to the node server.
+
+    The default station (id '') uses the original configuration keys
+    (temperature-main, Units, etc.) and node addresses.  Additional
+    stations are listed in the Stations parameter, their configuration
+    keys are prefixed with the station id (barn.temperature-main,
+    barn.Units), they send data to /<id>/... and their nodes are
+    addressed <id>_temp, <id>_wind, etc.
+
+    Each station has its own mapping, units, parse plan and ingest
+    queue/dispatcher so traffic from one station never waits behind
+    another.
+    """
+
+    def __init__(self, sid):
+        self.id = sid
+        self.units = 'metric'
+        self.in_units = 'metric'
+        self.incoming = uom.incoming('metric')
+        self.elevation = 0
+        self.map = {}
+        self.derived_map = {}
+        self.lists = {}
+        for kind in write_profile.NODE_DRVS:
+            self.lists[kind] = {}
+        self.derived = derived.DerivedMetrics(LOGGER)
+        self.processor = DataProcessor()
+        self.stats = stats.Statistics()
+        self.processor.derived = self.derived
+        self.processor.stats = self.stats
+        self.rain = rain.RainAccumulator()
+        self.processor.rain = self.rain
+        self.ingest = None
+        self.dispatcher = None
+
+    def address(self, kind):
+        if self.id == '':
+            return kind
+        return write_profile.nodedef_id(self.id, kind)
+
+    def node_name(self, name):
+        if self.id == '':
+            return name
+        return '%s %s' % (self.id, name)
+
+    def param(self, params, name):
+        if self.id != '':
+            name = '%s.%s' % (self.id, name)
+        return params[name] if name in params else None
+
+    def clear(self):
+        self.map.clear()
+        self.derived_map.clear()
+        for kind in self.lists:
+            self.lists[kind].clear()
+
+    def start(self, controller, queue_size, overflow, timeout):
+        self.processor.controller = controller
+        self.processor.nodes = controller.nodes
+        # give the station a chance to send data before it's offline
+        self.processor.seen = time.time()
+        self.ingest = ingest.IngestQueue(queue_size, overflow, timeout)
+        self.dispatcher = ingest.Dispatcher(self.ingest,
+                self.processor.process, LOGGER,
+                'weather-dispatch-%s' % (self.id or 'default'))
+        self.dispatcher.start()
+
+    def stop(self):
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+
+
 class Server(http.server.HTTPServer):
+    """
+    HTTP server that hands each accepted connection to a bounded pool of
+    worker threads so that one slow client doesn't block the uploads
+    from every other station.  At most max_requests connections are
+    allowed to be in-flight (queued or running) at a time, anything
+    beyond that is dropped.  The handlers only queue the request data
+    on the station's ingest queue, the parsing is done by the station's
+    dispatcher.  History queries are answered by the worker from the
+    history store.
+    """
     stop = False
+    serving = False
+
+    def __init__(self, address, handler, stations, workers=4, max_requests=16,
+            history=None):
+        http.server.HTTPServer.__init__(self, address, handler)
+        self.stations = stations
+        self.history = history
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                thread_name_prefix='weather-http')
+        self.inflight = threading.BoundedSemaphore(max_requests)
+
+    def serve_forever(self):
+        self.serving = True
+        socketserver.BaseServer.serve_forever(self, poll_interval=0.5)
+
+    # Find the queue for the station the request is for. Requests for
+    # additional stations start with /<station id>/, that part of the
+    # path is removed before it is queued.
+    def route(self, path):
+        parts = path.split('/', 2)
+        if len(parts) == 3 and parts[1] in self.stations:
+            return self.stations[parts[1]].ingest, '/' + parts[2]
+        return self.stations[''].ingest, path
+
+    def process_request(self, request, client_address):
+        if not self.inflight.acquire(blocking=False):
+            LOGGER.warning('Too many requests in progress, dropping %s' %
+                    client_address[0])
+            self.shutdown_request(request)
+            return
+
+        try:
+            self.pool.submit(self.process_request_thread, request,
+                    client_address)
+        except RuntimeError:
+            # pool has been shut down
+            self.inflight.release()
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.inflight.release()
 
-    def serve_forever(self, cfg_map, nodes):
-        self.RequestHandlerClass.node_map = cfg_map
-        self.RequestHandlerClass.nodes = nodes
-        while not self.stop:
-            http.server.HTTPServer.handle_request(self)
-        #http.server.HTTPServer.serve_forever(self)
+    def handle_error(self, request, client_address):
+        LOGGER.error('Error handling request from %s' % client_address[0],
+                exc_info=True)
 
     def stop_server(self):
+        if self.stop:
+            return
         self.stop = True
+        if self.serving:
+            self.shutdown()
+        self.server_close()
+        self.pool.shutdown(wait=False)
 
 if __name__ == "__main__":
     try:
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
 import collections
+import hashlib
+import io
 import re
 import os
 import zipfile
 import json
+import atomic
 
 pfx = "write_profile:"
 
 VERSION_FILE = "profile/version.txt"
+NODEDEF_FILE = "profile/nodedef/nodedefs.xml"
+PROFILE_ZIP = "profile.zip"
+
+# Profile files that aren't generated but are part of the zip file
+STATIC_FILES = ("profile/nls/en_us.txt", "profile/editor/editors.xml")
 
 # define templates for the various sensor nodes we have available. Each
 # sensor node will have a pre-defined list of drivers. When we build
@@ -79,6 +87,7 @@ WIND_DRVS = {
         'gustdir' : 'GV2',
         'lullspeed' : 'GV3',
         'avgwindspeed' : 'GV4',
+        'avgwinddir' : 'GV5',
         }
 
 RAIN_DRVS = {
@@ -111,141 +120,213 @@ LTNG_DRVS = {
         'distance' : 'GV0'
         }
 
+# Driver tables for each node type, keyed by the node name used in the
+# configuration (temperature-main, rain-daily, etc.)
+NODE_DRVS = {
+        'temperature' : TEMP_DRVS,
+        'humidity' : HUMD_DRVS,
+        'pressure' : PRES_DRVS,
+        'wind' : WIND_DRVS,
+        'rain' : RAIN_DRVS,
+        'light' : LITE_DRVS,
+        'lightning' : LTNG_DRVS,
+        }
+
+# Node definition id and NLS prefix for each node type
+NODE_DEFS = {
+        'temperature' : ('temperature', '139T'),
+        'humidity' : ('humidity', '139H'),
+        'pressure' : ('pressure', '139P'),
+        'wind' : ('wind', '139W'),
+        'rain' : ('precipitation', '139R'),
+        'light' : ('light', '139L'),
+        'lightning' : ('lightning', '139S'),
+        }
+
+# Short names used to build the node address/definition id for the
+# nodes of additional stations. I.E. barn_temp. Addresses are limited
+# to 14 characters.
+NODE_SHORT = {
+        'temperature' : 'temp',
+        'humidity' : 'humd',
+        'pressure' : 'pres',
+        'wind' : 'wind',
+        'rain' : 'rain',
+        'light' : 'lite',
+        'lightning' : 'ltng',
+        }
+
+def nodedef_id(station, kind):
+    if station == '':
+        return NODE_DEFS[kind][0]
+    return '%s_%s' % (station, NODE_SHORT[kind])
+
 
 NODEDEF_TMPL = "  <nodeDef id=\"%s\" nodeType=\"139\" nls=\"%s\">\n"
 STATUS_TMPL = "      <st id=\"%s\" editor=\"%s\" />\n"
 
+CONTROLLER_NODEDEF = (
+        NODEDEF_TMPL % ('WeatherPoly', 'ctl') +
+        "    <sts>\n"
+        "      <st id=\"ST\" editor=\"bool\" />\n"
+        "      <st id=\"GV0\" editor=\"I_VOLTS\" />\n"
+        "      <st id=\"GV1\" editor=\"I_VOLTS\" />\n"
+        "      <st id=\"GV2\" editor=\"I_RSSI\" />\n"
+        "      <st id=\"GV3\" editor=\"I_RSSI\" />\n"
+        "    </sts>\n"
+        "    <cmds>\n"
+        "      <sends />\n"
+        "      <accepts>\n"
+        "        <cmd id=\"DISCOVER\" />\n"
+        "        <cmd id=\"REMOVE_NOTICES_ALL\" />\n"
+        "        <cmd id=\"UPDATE_PROFILE\" />\n"
+        "      </accepts>\n"
+        "    </cmds>\n"
+        "  </nodeDef>\n\n")
+
+# (station, kind) -> (driver list, node definition) of the last node
+# definitions built, so only the nodes whose drivers changed are built
+# again.
+sections = {}
+
+def nodedef_section(station, kind, drv_list):
+    drivers = tuple(drv_list.items())
+    cached = sections.get((station, kind))
+    if cached is not None and cached[0] == drivers:
+        return cached[1]
+
+    # Need to translate temperature.main into <st id="ST" editor="TEMP_C" />
+    # and     translate temperature.extra1 into <st id="GV5" editor="TEMP_C" />
+    text = [NODEDEF_TMPL % (nodedef_id(station, kind), NODE_DEFS[kind][1])]
+    text.append("    <sts>\n")
+    for t, editor in drivers:
+        text.append(STATUS_TMPL % (NODE_DRVS[kind][t], editor))
+    text.append("    </sts>\n")
+    text.append("  </nodeDef>\n")
+    text = ''.join(text)
+    sections[(station, kind)] = (drivers, text)
+    return text
+
 # As long as we provide proper dictionary lists for each type of node
 # this will generate the node definitions.
 #
+# lists is a dictionary of node type -> driver list for the default
+# station, stations is an optional dictionary of station id to a
+# dictionary of node type -> list for additional stations.  Returns the
+# contents of nodedefs.xml, nothing is written.
+#
 # Assumes that the NLS exist for the nodes and that the editors exist.
 
+def build_nodedefs(lists, stations=None):
+    text = ["<nodeDefs>\n", CONTROLLER_NODEDEF]
+    all_lists = [('', lists)]
+    # Additional stations get their own node definitions since each
+    # can map a different set of drivers.
+    if stations:
+        for station in stations:
+            all_lists.append((station, stations[station]))
+
+    for station, station_lists in all_lists:
+        for kind in NODE_DRVS:
+            if len(station_lists[kind]) > 0:
+                text.append(nodedef_section(station, kind,
+                    station_lists[kind]))
+    text.append("</nodeDefs>")
+    return ''.join(text)
+
 def write_profile(logger, temperature_list, humidity_list, pressure_list,
-        wind_list, rain_list, light_list, lightning_list):
+        wind_list, rain_list, light_list, lightning_list, stations=None):
     sd = get_server_data(logger)
     if sd is False:
         logger.error("Unable to complete without server data...")
         return False
 
-    logger.info("{0} Writing profile/nodedef/nodedefs.xml".format(pfx))
-    if not os.path.exists("profile/nodedef"):
-        try:
-            os.makedirs("profile/nodedef")
-        except:
-            logger.error('unable to create node definition directory.')
+    lists = {
+            'temperature' : temperature_list,
+            'humidity' : humidity_list,
+            'pressure' : pressure_list,
+            'wind' : wind_list,
+            'rain' : rain_list,
+            'light' : light_list,
+            'lightning' : lightning_list,
+            }
+    try:
+        generated = {
+                NODEDEF_FILE : build_nodedefs(lists, stations).encode(),
+                VERSION_FILE : sd['profile_version'].encode(),
+                }
+    except KeyError as e:
+        logger.error('Failed to build node definitions, unknown %s' % str(e))
+        return False
 
+    # Each file is written to a temporary file and renamed over the old
+    # one, a failure leaves the previous profile in place.
     try:
-        nodedef = open("profile/nodedef/nodedefs.xml", "w")
-        nodedef.write("<nodeDefs>\n")
-
-        # First, write the controller node definition
-        nodedef.write(NODEDEF_TMPL % ('WeatherPoly', 'ctl'))
-        nodedef.write("    <sts>\n")
-        nodedef.write("      <st id=\"ST\" editor=\"bool\" />\n")
-        nodedef.write("      <st id=\"GV0\" editor=\"I_VOLTS\" />\n")
-        nodedef.write("      <st id=\"GV1\" editor=\"I_VOLTS\" />\n")
-        nodedef.write("    </sts>\n")
-        nodedef.write("    <cmds>\n")
-        nodedef.write("      <sends />\n")
-        nodedef.write("      <accepts>\n")
-        nodedef.write("        <cmd id=\"DISCOVER\" />\n")
-        nodedef.write("        <cmd id=\"REMOVE_NOTICES_ALL\" />\n")
-        nodedef.write("        <cmd id=\"UPDATE_PROFILE\" />\n")
-        nodedef.write("      </accepts>\n")
-        nodedef.write("    </cmds>\n")
-        nodedef.write("  </nodeDef>\n\n")
-
-        # Need to translate temperature.main into <st id="ST" editor="TEMP_C" />
-        # and     translate temperature.extra1 into <st id="GV5" editor="TEMP_C" />
-
-        if (len(temperature_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('temperature', '139T'))
-            nodedef.write("    <sts>\n")
-            for t in temperature_list:
-                nodedef.write(STATUS_TMPL % (TEMP_DRVS[t], temperature_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        if (len(humidity_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('humidity', '139H'))
-            nodedef.write("    <sts>\n")
-            for t in humidity_list:
-                nodedef.write(STATUS_TMPL % (HUMD_DRVS[t], humidity_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        if (len(pressure_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('pressure', '139P'))
-            nodedef.write("    <sts>\n")
-            for t in pressure_list:
-                nodedef.write(STATUS_TMPL % (PRES_DRVS[t], pressure_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        if (len(wind_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('wind', '139W'))
-            nodedef.write("    <sts>\n")
-            for t in wind_list:
-                nodedef.write(STATUS_TMPL % (WIND_DRVS[t], wind_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        if (len(rain_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('precipitation', '139R'))
-            nodedef.write("    <sts>\n")
-            for t in rain_list:
-                nodedef.write(STATUS_TMPL % (RAIN_DRVS[t], rain_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        if (len(light_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('light', '139L'))
-            nodedef.write("    <sts>\n")
-            for t in light_list:
-                nodedef.write(STATUS_TMPL % (LITE_DRVS[t], light_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        if (len(lightning_list) > 0):
-            nodedef.write(NODEDEF_TMPL % ('lightning', '139S'))
-            nodedef.write("    <sts>\n")
-            for t in lightning_list:
-                nodedef.write(STATUS_TMPL % (LTNG_DRVS[t], lightning_list[t]))
-            nodedef.write("    </sts>\n")
-            nodedef.write("  </nodeDef>\n")
-
-        nodedef.write("</nodeDefs>")
-
-        nodedef.close()
-    except:
-        logger.error('Failed to write node definition file.')
-
-    # Update the profile version file with the info from server.json
-    with open(VERSION_FILE, 'w') as outfile:
-        outfile.write(sd['profile_version'])
-    outfile.close()
-
-    # Create the zip file that can be uploaded to the ISY
-    write_profile_zip(logger)
+        for name in generated:
+            logger.info("{0} Writing {1}".format(pfx, name))
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            atomic.write_file(name, generated[name])
+
+        # Create the zip file that can be uploaded to the ISY
+        write_profile_zip(logger, generated)
+    except OSError as e:
+        logger.error('Failed to write profile: %s' % str(e))
+        return False
 
     logger.info(pfx + " done.")
+    return True
 
 
-def write_profile_zip(logger):
+# Zip the generated files from memory along with the rest of the profile
+# files from disk.
+def write_profile_zip(logger, generated=None):
+    if generated is None:
+        generated = {}
     src = 'profile'
-    abs_src = os.path.abspath(src)
-    with zipfile.ZipFile('profile.zip', 'w') as zf:
-        for dirname, subdirs, files in os.walk(src):
-            # Ignore dirs starint with a dot, stupid .AppleDouble...
-            if not "/." in dirname:
-                for filename in files:
-                    if filename.endswith('.xml') or filename.endswith('txt'):
-                        absname = os.path.abspath(os.path.join(dirname, filename))
-                        arcname = absname[len(abs_src) + 1:]
-                        logger.info('write_profile_zip: %s as %s' %
-                                (os.path.join(dirname, filename), arcname))
-                        zf.write(absname, arcname)
-    zf.close()
+    files = {}
+    for dirname, subdirs, names in os.walk(src):
+        # Ignore dirs starint with a dot, stupid .AppleDouble...
+        if not "/." in dirname:
+            for filename in names:
+                if filename.endswith('.xml') or filename.endswith('txt'):
+                    path = os.path.join(dirname, filename)
+                    if path not in generated:
+                        with open(path, 'rb') as f:
+                            files[path] = f.read()
+    files.update(generated)
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for path in sorted(files):
+            arcname = os.path.relpath(path, src)
+            logger.info('write_profile_zip: %s as %s' % (path, arcname))
+            zf.writestr(arcname, files[path])
+    atomic.write_file(PROFILE_ZIP, buf.getvalue())
+
+
+# Hash of the profile: the generated node definitions, the version and
+# the static files. If it's the same as the hash of the profile that was
+# last installed, there's no need to write the profile again or to push
+# it to the ISY.
+def profile_hash(logger, lists, stations):
+    sd = get_server_data(logger)
+    if sd is False:
+        return None
+    try:
+        nodedefs = build_nodedefs(lists, stations)
+    except KeyError:
+        return None
+
+    h = hashlib.sha256()
+    h.update(nodedefs.encode())
+    h.update(b'\0' + sd['profile_version'].encode() + b'\0')
+    for name in STATIC_FILES:
+        try:
+            with open(name, 'rb') as f:
+                h.update(f.read())
+        except OSError:
+            return None
+    return h.hexdigest()
 
 
 def get_server_data(logger):